@@ -0,0 +1,344 @@
+"""
+Benchmark for bh_rebrand.py
+
+Runs the Word, Excel, PowerPoint and PDF processors over a copy of a folder of sample files (sample_files_100 by
+default) and writes the throughput, the latency per file type and the peak memory use as JSON, so the results of
+different versions of the script can be compared.
+
+The COM conversions of .doc and .xls files need Microsoft Office on Windows. Without it they are replaced by a
+stand-in that converts with LibreOffice when it is installed and skips the file otherwise. Converting the processed
+PDF files back from .docx is not part of the benchmark.
+
+Usage: python benchmark_rebrand.py [--config default_bh_rebrand.cfg] [--input sample_files_100]
+                                   [--output bench_results.json] [--label name]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+
+import bh_rebrand
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Config entries pointing to the replacement images shipped next to the script
+IMAGE_PATHS = ['NewLogoPath', 'ReplacementImageDarkSmall', 'ReplacementImageDarkLarge', 'ReplacementImageWhiteSmall',
+               'ReplacementImageWhiteLarge']
+
+FILE_TYPES = {
+    '.doc': 'word',
+    '.docx': 'word',
+    '.docm': 'word',
+    '.xls': 'excel',
+    '.xlsx': 'excel',
+    '.pptx': 'powerpoint',
+    '.pdf': 'pdf'
+}
+
+# Extensions of the files converted in the header phase, their body images are replaced under the new name
+CONVERTED_EXTENSIONS = {
+    '.doc': '.docx',
+    '.docm': '.docx',
+    '.xls': '.xlsx',
+    '.pdf': '.docx'
+}
+
+
+class SkippedFile(Exception):
+    """
+    Raised for files that can't be processed on this machine
+    """
+
+
+def convert_file_stand_in(file, new_file_format):
+    """
+    Stand-in for bh_rebrand.convert_file, which needs the Office COM servers. Converts the file with LibreOffice when
+    it is installed, same as convert_file the original file is replaced by the converted one.
+
+    Parameters
+    ----------
+    file: string
+        path to the .doc or .xls file
+
+    new_file_format: int
+        FILE_FORMAT_DOCX or FILE_FORMAT_XLSX
+
+    Returns
+    -------
+    new_file: string
+        path to the converted file
+    """
+    extension = 'docx' if new_file_format == bh_rebrand.FILE_FORMAT_DOCX else 'xlsx'
+    office = shutil.which('soffice') or shutil.which('libreoffice')
+    if office is None:
+        raise SkippedFile(f'No converter to {extension} available')
+
+    folder_path = os.path.dirname(file)
+    subprocess.run([office, '--headless', '--convert-to', extension, '--outdir', folder_path, file],
+                   check=True, capture_output=True, timeout=300)
+    os.remove(file)
+
+    return os.path.join(folder_path, f'{os.path.splitext(os.path.basename(file))[0]}.{extension}')
+
+
+def prepare_config(config_file, input_folder, work_folder):
+    """
+    Reads the config file and points every folder of it into the work folder, with a copy of the input files
+
+    Parameters
+    ----------
+    config_file: string
+        path to the configuration file
+
+    input_folder: string
+        folder with the sample files
+
+    work_folder: string
+        empty folder for the copies and the output of the run
+
+    Returns
+    -------
+    config: dictionary
+        content of the configuration file with the paths of the benchmark
+    """
+    config = bh_rebrand.map_config(config_file)
+
+    # The script concatenates folder paths and file names, so they need a trailing separator
+    for folder in bh_rebrand.FOLDERS + ['ProcessedFolder']:
+        config[folder] = os.path.join(work_folder, folder) + os.sep
+        os.makedirs(config[folder])
+
+    config['InputFolder'] = os.path.join(work_folder, 'InputFolder')
+    shutil.copytree(input_folder, config['InputFolder'])
+
+    # Use the replacement images next to the script if the configured ones don't exist on this machine
+    for image_path in IMAGE_PATHS:
+        if not os.path.exists(config[image_path]):
+            config[image_path] = os.path.join(SCRIPT_FOLDER, config[image_path].replace('\\', '/').split('/')[-1])
+
+    return config
+
+
+def run_benchmark(config):
+    """
+    Processes every file of the input folder in the same order and phases as bh_rebrand.main
+
+    Parameters
+    ----------
+    config: dictionary
+        content of the configuration file with the paths of the benchmark
+
+    Returns
+    -------
+    records: list
+        one dictionary per file with its type, status and processing time in seconds
+    """
+    output_folder = config['HeaderImageReplacedFoler'] if config['CompareLogoByPixels'] else config['OutputFolder']
+    # Records by file name, and by the name of the converted file for the files converted in the header phase
+    records = {}
+    converted_records = {}
+
+    # Sort files to process Word files first before other file types
+    sorted_files = sorted(os.listdir(config['InputFolder']),
+                          key=lambda x: (not x.lower().endswith(('.docx', '.doc', '.docm')), x))
+
+    for file in sorted_files:
+        file_in = os.path.join(config['InputFolder'], file)
+        file_type = FILE_TYPES.get(os.path.splitext(file)[1].lower())
+        if file_type is None or os.path.isdir(file_in) or os.path.getsize(file_in) == 0:
+            continue
+
+        config = bh_rebrand.get_filetype(file, config)
+        config['OldLogoPath_formatted'] = config['OldLogoPath'].format(filetype=config['filetype'])
+        config['LegacyBHLogoPath_formatted'] = config['LegacyBHLogoPath'].format(filetype=config['filetype'])
+
+        record = {'file': file, 'type': file_type, 'status': 'ok', 'seconds': 0.0, 'error': ''}
+        records[file] = record
+        file_stem, file_extension = os.path.splitext(file)
+        if file_extension.lower() in CONVERTED_EXTENSIONS:
+            converted_records.setdefault(file_stem + CONVERTED_EXTENSIONS[file_extension.lower()], record)
+
+        start_time = perf_counter()
+        try:
+            bh_rebrand.log_information['Inputfile'] = file_in
+            bh_rebrand.process_file(file_in, os.path.join(output_folder, file), config)
+        except SkippedFile as e:
+            record['status'] = 'skipped'
+            record['error'] = str(e)
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = repr(e)
+        record['seconds'] += perf_counter() - start_time
+        bh_rebrand.reset_log_info()
+
+    # Replace the body images, the time is added to the file it belongs to
+    if config['CompareLogoByPixels']:
+        for file_body, file_in, rewrite in bh_rebrand.body_phase_files(config):
+            record = records.get(file_body, converted_records.get(file_body))
+            config = bh_rebrand.get_filetype(file_body, config)
+            if record is None or 'filetype' not in config:
+                continue
+
+            start_time = perf_counter()
+            try:
+                file_out = os.path.join(config['OutputFolder'], file_body)
+                if rewrite:
+                    # Word files scanned in the header phase are written once, with text, header and body images
+                    config['OldLogoPath_formatted'] = config['OldLogoPath'].format(filetype=config['filetype'])
+                    config['LegacyBHLogoPath_formatted'] = config['LegacyBHLogoPath'].format(
+                        filetype=config['filetype'])
+                    bh_rebrand.process_file_word(file_in, file_out, config, body_images=True)
+                else:
+                    bh_rebrand.place_logo_body(file_in, file_out, config)
+            except Exception as e:
+                record['status'] = 'failed'
+                record['error'] = repr(e)
+            record['seconds'] += perf_counter() - start_time
+            bh_rebrand.reset_log_info()
+
+    return list(records.values())
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size in MB of this process ('self') and of its finished child processes
+    ('children') as a dictionary, or None if it can't be measured on this platform
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {'self': usage / unit, 'children': usage_children / unit}
+
+
+def summarize(records, wall_time):
+    """
+    Builds the result of the run
+
+    Parameters
+    ----------
+    records: list
+        per file records returned by run_benchmark
+
+    wall_time: float
+        duration of the run in seconds
+
+    Returns
+    -------
+    summary: dictionary
+        throughput, latency percentiles per file type and peak memory use
+    """
+    processed = [record for record in records if record['status'] == 'ok']
+
+    types = {}
+    for file_type in sorted({record['type'] for record in records}):
+        type_records = [record for record in records if record['type'] == file_type]
+        latencies = [record['seconds'] for record in type_records if record['status'] == 'ok']
+        types[file_type] = {
+            'files': len(type_records),
+            'ok': len(latencies),
+            'failed': sum(record['status'] == 'failed' for record in type_records),
+            'skipped': sum(record['status'] == 'skipped' for record in type_records),
+            'p50_seconds': float(np.percentile(latencies, 50)) if latencies else None,
+            'p95_seconds': float(np.percentile(latencies, 95)) if latencies else None,
+            'mean_seconds': float(np.mean(latencies)) if latencies else None,
+            'total_seconds': float(np.sum(latencies))
+        }
+
+    return {
+        'files': len(records),
+        'ok': len(processed),
+        'failed': sum(record['status'] == 'failed' for record in records),
+        'skipped': sum(record['status'] == 'skipped' for record in records),
+        'wall_seconds': wall_time,
+        'files_per_second': len(processed) / wall_time if wall_time else None,
+        'image_comparisons': bh_rebrand.image_comparisons,
+        'cascade': dict(bh_rebrand.cascade_counts),
+        'peak_rss_mb': peak_rss_mb(),
+        'types': types
+    }
+
+
+def git_revision():
+    """
+    Returns the git commit of the script folder, if any
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_FOLDER, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """
+    Runs the benchmark and writes the results
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the rebranding of a folder of sample files')
+    parser.add_argument('--config', default=os.path.join(SCRIPT_FOLDER, 'default_bh_rebrand.cfg'),
+                        help='configuration file, its folders are replaced by temporary ones')
+    parser.add_argument('--input', default=os.path.join(SCRIPT_FOLDER, 'sample_files_100'),
+                        help='folder with the sample files, it is copied and left unchanged')
+    parser.add_argument('--output', default='bench_results.json', help='JSON file to write the results to')
+    parser.add_argument('--label', default='', help='name of the run stored with the results')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary folder with the output files')
+    arguments = parser.parse_args()
+
+    # Office conversions are not available outside Windows
+    if bh_rebrand.win32 is None:
+        bh_rebrand.convert_file = convert_file_stand_in
+
+    work_folder = tempfile.mkdtemp(prefix='bh_rebrand_benchmark_')
+    try:
+        config = prepare_config(arguments.config, arguments.input, work_folder)
+
+        start_time = perf_counter()
+        records = run_benchmark(config)
+        wall_time = perf_counter() - start_time
+    finally:
+        if arguments.keep:
+            print(f'Output files kept in {work_folder}')
+        else:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    results = {
+        'label': arguments.label,
+        'revision': git_revision(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'input': os.path.abspath(arguments.input),
+        'summary': summarize(records, wall_time),
+        'records': records
+    }
+
+    with open(arguments.output, 'w', encoding='utf-8') as output:
+        json.dump(results, output, indent=2)
+
+    summary = results['summary']
+    print(f"{summary['ok']}/{summary['files']} files in {wall_time:.2f} seconds "
+          f"({summary['files_per_second']:.2f} files/sec), {summary['failed']} failed, {summary['skipped']} skipped")
+    for file_type, stats in summary['types'].items():
+        if stats['ok']:
+            print(f"{file_type}: p50 {stats['p50_seconds']:.3f}s, p95 {stats['p95_seconds']:.3f}s ({stats['ok']} files)")
+    print(f'Results written to {arguments.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -14,23 +14,44 @@ import os
 import xml
 from time import time, strftime, gmtime, sleep
 from datetime import datetime
-from re import search, findall
-from zipfile import ZipFile, ZIP_DEFLATED
+from re import search, findall, sub, escape
+from re import compile as compile_pattern
+from io import BytesIO
+from xml.sax.saxutils import escape as escape_xml
+from bisect import bisect_right
+from itertools import accumulate
+from collections import OrderedDict
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+import sqlite3
+import json
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, ZIP64_LIMIT, BadZipFile
+from zipfile import structFileHeader, sizeFileHeader, stringFileHeader, _FH_FILENAME_LENGTH, _FH_EXTRA_FIELD_LENGTH
+from struct import unpack
 
 import lxml.etree
 import pptx
 from docx import Document
-import comtypes.client
 import xml.etree.ElementTree as ET
-import win32com.client as win32
 import shutil
 import pathlib
 from PIL import Image
 import numpy as np
 from pptx import Presentation
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import nsdecls
 from pdf2docx import Converter as ConverterPdf2Docx
 from docx2pdf import convert as ConvertDocx2Pdf
 
+# COM automation of the Office applications only exists on Windows, without it .doc and .xls files can't be converted
+try:
+    import comtypes.client
+    import win32com.client as win32
+except ImportError:
+    comtypes = None
+    win32 = None
+
 FILE_FORMAT_PDF_WORD = 17
 FILE_FORMAT_PDF_EXCEL = 0
 FILE_FORMAT_PDF_PPT = 2
@@ -38,7 +59,13 @@ FILE_FORMAT_XLSX = 51
 FILE_FORMAT_DOCX = 16
 different_logos_found = 800
 image_comparisons = 0
+# Images checked against the logo catalog, the candidate logos rejected by each stage of the cascade in
+# find_matching_logo and the images matched in the last stage
+cascade_counts = {'images': 0, 'size': 0, 'colour': 0, 'hash': 0, 'pixels': 0, 'matched': 0}
 header_images = {}
+# Word files scan_word_headers scanned in the header phase, rewritten once from the InputFolder in the body image
+# phase. Files converted to .docx are recorded in header_images as well, but not scanned.
+scanned_word_files = set()
 file_run_times = {
     'excel': 0.0,
     'word': 0.0,
@@ -56,11 +83,46 @@ log_information = {
     'Warning': ''
 }
 
+# Namespaces of the WordprocessingML parts rewritten without python-docx
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+DRAWING_NAMESPACE = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+DC_TITLE = '{http://purl.org/dc/elements/1.1/}title'
+
+# Worksheet elements holding the header and footer strings and the size of the chunks the worksheets are copied in
+HEADER_FOOTER_TAGS = ('oddHeader', 'oddFooter', 'evenHeader', 'evenFooter', 'firstHeader', 'firstFooter')
+WORKSHEET_CHUNK_SIZE = 1024 * 1024
+# Size of the chunks the XML parts are read in when they're checked for possible rule hits
+XML_SCAN_CHUNK_SIZE = 1024 * 1024
+# Size of the chunks the compressed data of unchanged Zip entries is copied in
+ZIP_COPY_CHUNK_SIZE = 1024 * 1024
+# Attributes of zipfile.ZipFile that ZipRewriter.raw_copy writes entries through, not part of the public API
+RAW_COPY_INTERNALS = ('_lock', '_seekable', '_writecheck', '_didModify', 'start_dir', 'fp', 'filelist', 'NameToInfo')
+# Compression methods that can be chosen for the entries of the output packages
+COMPRESSION_METHODS = {'store': ZIP_STORED, 'deflate': ZIP_DEFLATED}
+# Part of the catalog version of the cached comparison verdicts, has to be increased whenever compare_images or the
+# candidate search changes its results
+COMPARISON_VERSION = 5
+# Mean pixel deviation below which two images are similar, and the file of the FoundLogosFolder with the larger
+# tolerances of the logos that represent a cluster of near-duplicates. Besides the deviation, the tolerances of a
+# representative widen the perceptual hash distance by hash_margin bits and the aspect ratio by aspect_margin
+DEVIATION_THRESHOLD = 15
+CATALOG_TOLERANCES_FILE = 'catalog_tolerances.json'
+DEFAULT_TOLERANCES = {'tolerance': DEVIATION_THRESHOLD, 'hash_margin': 0, 'aspect_margin': 1.0}
+# PIL modes Image.reduce averages correctly, palette and bilevel images are converted to RGB before they are reduced
+REDUCIBLE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr')
+
 FOLDERS = ['OutputFolder', 'LogFolder', 'BetweenFolder', 'HeaderImageReplacedFoler', 'FoundLogosFolder', 'ImagesFolder']
 
 # Hold PDF Document ID numbers to keep track of .docx files that need to be converted back to PDF
 pdfs = []
 
+# Header images found by a worker process of the pool, added to the catalog by the main process in the order of the
+# files. None when the images are added to the catalog right away.
+catalog_images = None
+# Config of the worker processes of the pool
+worker_config = None
+
 """def count_docx(file_name):
     document = Document(file_name)
 
@@ -78,55 +140,253 @@ def shuttle_text(shuttle):
     return t"""
 
 
-def replace_text(runs, target, replace):
+class ReplaceMatcher:
     """
-    Replaces the target string with the replace string in the runs.
+    Aho-Corasick automaton compiled once from the ReplaceString rules of the config file.
+    Finds the hits of every rule in a single pass over a text, so the cost of a replacement no longer grows with
+    the number of rules. Overlapping hits are resolved leftmost-longest, the earlier rule wins on equal targets.
 
-    Parameters:
-    - runs (List[Run]): List of runs to search and replace within.
-    - target (str): The string to be replaced.
-    - replace (str): The replacement string.
+    Parameters
+    ----------
+    replace_strings: list
+        [old, new] pairs as gathered by map_config
     """
-    begin = 0
-    full_text = ""
-    for end, run in enumerate(runs):
-        if run.text is not None:
-            full_text += run.text
-
-            if target in full_text:
-
-                # Find the beginning index
-                index = full_text.index(target)
-                while index >= len(runs[begin].text):
-                    index -= len(runs[begin].text)
-                    begin += 1
 
-                # Find the corresponding runs
-                shuttle = runs[begin:end + 1]
+    def __init__(self, replace_strings):
+        self.replacements = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
 
-                # Perform the replace operation
-                if target in shuttle[0].text:
-                    shuttle[0].text = shuttle[0].text.replace(target, replace)
-                else:
-                    replace_begin_index = full_text.index(target)
-                    replace_end_index = replace_begin_index + len(target)
-                    replace_end_index_in_last_run = replace_end_index - len(''.join(run.text for run in shuttle[:-1]))
-                    shuttle[0].text = shuttle[0].text[:replace_begin_index] + replace
+        for old, new in replace_strings:
+            # Rules replacing a string with itself or a target already defined by an earlier rule never change
+            # the text
+            if not old or old == new or any(old == target for target, _ in self.replacements):
+                continue
+            state = 0
+            for char in old:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._out[state].append((len(old), len(self.replacements)))
+            self.replacements.append((old, new))
+
+        # Byte patterns of the targets, as plain and as XML-escaped text (GE Oil & Gas -> GE Oil &amp; Gas)
+        triggers = set()
+        for old, _ in self.replacements:
+            triggers.add(old.encode('utf-8'))
+            triggers.add(escape_xml(old).encode('utf-8'))
+        self._trigger_pattern = compile_pattern(b'|'.join(escape(trigger) for trigger in sorted(triggers)))
+        self._trigger_length = max((len(trigger) for trigger in triggers), default=0)
+
+        # Breadth-first pass to set the failure links and merge the outputs of the suffix states
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+                queue.append(next_state)
+
+    def may_match(self, xml_data):
+        """
+        Byte-level prefilter for a raw XML part. The tags are stripped first so hits split over several runs are
+        still found. A part for which this returns False holds no rule hit and can be copied without parsing it.
+
+        Parameters
+        ----------
+        xml_data: bytes
+            raw content of the XML part
+
+        Returns
+        -------
+        bool: True if the part might contain a rule hit
+        """
+        if not self.replacements:
+            return False
+        # Only UTF-8 parts can be scanned as bytes
+        if xml_data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+            return True
+        return self._trigger_pattern.search(sub(rb'<[^>]*>', b'', xml_data)) is not None
+
+    def may_match_stream(self, part_in, chunk_size=XML_SCAN_CHUNK_SIZE):
+        """
+        Same prefilter as may_match for a part read in chunks, so the part is never held as a whole. A tag split over
+        two chunks is completed with the next chunk, and the end of the text of a chunk is kept for the hits that
+        continue in the next one.
+
+        Parameters
+        ----------
+        part_in: file obj
+            readable XML part, e.g. from ZipFile.open
+
+        chunk_size: int
+            number of bytes read at a time
+
+        Returns
+        -------
+        bool: True if the part might contain a rule hit
+        """
+        if not self.replacements:
+            return False
+
+        pending = b''  # Bytes read but not scanned yet, from the start of an unfinished tag
+        text_tail = b''  # End of the text scanned so far, shorter than the longest trigger
+        first_chunk = True
+
+        while True:
+            chunk = part_in.read(chunk_size)
+            if first_chunk:
+                # Only UTF-8 parts can be scanned as bytes
+                if chunk[:2] in (b'\xff\xfe', b'\xfe\xff'):
+                    return True
+                first_chunk = False
+
+            pending += chunk
+            # Keep an unfinished tag for the next chunk
+            tag_start = pending.rfind(b'<')
+            if chunk and tag_start != -1 and pending.find(b'>', tag_start) == -1:
+                complete, pending = pending[:tag_start], pending[tag_start:]
+            else:
+                complete, pending = pending, b''
+
+            text = text_tail + sub(rb'<[^>]*>', b'', complete)
+            if self._trigger_pattern.search(text) is not None:
+                return True
+            text_tail = text[len(text) - self._trigger_length + 1:] if self._trigger_length > 1 else b''
+
+            if not chunk:
+                return False
+
+    def find_all(self, text):
+        """
+        Finds all non-overlapping rule hits in the text
+
+        Parameters
+        ----------
+        text: string
+            text to search
+
+        Returns
+        -------
+        matches: list
+            (start, end, replacement) tuples ordered by their position in the text
+        """
+        hits = []
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for length, rule in self._out[state]:
+                hits.append((position + 1 - length, -length, rule))
+
+        matches = []
+        last_end = 0
+        for start, negative_length, rule in sorted(hits):
+            if start >= last_end:
+                last_end = start - negative_length
+                matches.append((start, last_end, self.replacements[rule][1]))
+        return matches
+
+    def replace(self, text):
+        """
+        Returns the text with every rule hit replaced
+        """
+        if not text:
+            return text
+        parts = []
+        last_end = 0
+        for start, end, replacement in self.find_all(text):
+            parts.append(text[last_end:start])
+            parts.append(replacement)
+            last_end = end
+        parts.append(text[last_end:])
+        return ''.join(parts)
+
+
+class RunIndex:
+    """
+    Text of a paragraph joined once, with a prefix-sum table of the run offsets so the runs covered by a hit are
+    found with a binary search instead of rescanning the runs
 
-                    # Clear middle runs
-                    for i in shuttle[1:-1]:
-                        i.text = ''
+    Parameters
+    ----------
+    runs: list
+        runs (or w:t elements) of the paragraph
+    """
 
-                    # Keep last run
-                    shuttle[-1].text = shuttle[-1].text[replace_end_index_in_last_run:]
+    def __init__(self, runs):
+        self.runs = [run for run in runs if run.text is not None]
+        self.texts = [run.text for run in self.runs]
+        self.offsets = list(accumulate((len(text) for text in self.texts), initial=0))
+        self.text = ''.join(self.texts)
+
+    def run_at(self, position):
+        """
+        Returns the index of the run containing the character at the position
+        """
+        return bisect_right(self.offsets, position) - 1
+
+    def apply(self, matches):
+        """
+        Rewrites the runs for all hits in one pass. A hit spanning several runs is written into its first run, which
+        keeps its formatting, the middle runs are cleared and the last run keeps the text after the hit.
+
+        Parameters
+        ----------
+        matches: list
+            (start, end, replacement) tuples ordered by position, as returned by ReplaceMatcher.find_all
+        """
+        # Edits per run as (start, end, replacement) in run-local offsets
+        edits = {}
+        for match_start, match_end, replace in matches:
+            first = self.run_at(match_start)
+            last = self.run_at(match_end - 1)
+            first_offset = self.offsets[first]
+            edits.setdefault(first, []).append(
+                (match_start - first_offset, min(match_end, self.offsets[first + 1]) - first_offset, replace))
+            # Clear middle runs
+            for middle in range(first + 1, last):
+                edits.setdefault(middle, []).append((0, len(self.texts[middle]), ''))
+            # Keep the end of the last run
+            if last != first:
+                edits.setdefault(last, []).append((0, match_end - self.offsets[last], ''))
+
+        for run_number, run_edits in edits.items():
+            text = self.texts[run_number]
+            parts = []
+            last_end = 0
+            for edit_start, edit_end, replace in run_edits:
+                parts.append(text[last_end:edit_start])
+                parts.append(replace)
+                last_end = edit_end
+            parts.append(text[last_end:])
+            self.runs[run_number].text = ''.join(parts)
+
+
+def replace_text(runs, matcher):
+    """
+    Replaces every rule hit of the matcher in the runs. A hit spanning several runs is written into the first run
+    and keeps its formatting.
 
-                # Reset the beginning index for the next iteration
-                begin = end + 1
-                full_text = ""
+    Parameters:
+    - runs (List[Run]): List of runs to search and replace within.
+    - matcher (ReplaceMatcher): Compiled replacement rules.
+    """
+    run_index = RunIndex(runs)
+    matches = matcher.find_all(run_index.text)
+    if matches:
+        run_index.apply(matches)
     return
 
 
-def docx_replace(doc, target, replace):
+def docx_replace(doc, matcher):
     warning = ''
     try:
         # Replace text in tables
@@ -135,10 +395,10 @@ def docx_replace(doc, target, replace):
                 for cell in row.cells:
                     for paragraph in cell.paragraphs:
                         # Replace text in table cells
-                        replace_text(paragraph.runs, target, replace)
+                        replace_text(paragraph.runs, matcher)
                         # Replace text in hyperlinks within table cells
                         for link in paragraph._element.xpath(".//w:hyperlink"):
-                            replace_text(link.xpath("w:r", namespaces=link.nsmap), target, replace)
+                            replace_text(link.xpath("w:r", namespaces=link.nsmap), matcher)
 
         # Replace text in headers and footers
         for section in doc.sections:
@@ -149,40 +409,40 @@ def docx_replace(doc, target, replace):
                     w_t_tags = paragraph._element.xpath(".//w:t")
 
                     # Replace text in header paragraphs
-                    replace_text(w_t_tags, target, replace)
+                    replace_text(w_t_tags, matcher)
 
                 for table in header.tables:
                     for row in table.rows:
                         for cell in row.cells:
                             for paragraph in cell.paragraphs:
                                 # Replace text in table cells within headers
-                                replace_text(paragraph.runs, target, replace)
+                                replace_text(paragraph.runs, matcher)
                                 # Replace text in hyperlinks within table cells within headers
                                 for link in paragraph._element.xpath(".//w:hyperlink"):
-                                    replace_text(link.xpath("w:r", namespaces=link.nsmap), target, replace)
+                                    replace_text(link.xpath("w:r", namespaces=link.nsmap), matcher)
 
             for footer in [section.footer, section.first_page_footer]:
                 for paragraph in footer.paragraphs:
                     # Replace text in footer paragraphs
-                    replace_text(paragraph.runs, target, replace)
+                    replace_text(paragraph.runs, matcher)
 
                 for table in footer.tables:
                     for row in table.rows:
                         for cell in row.cells:
                             for paragraph in cell.paragraphs:
                                 # Replace text in table cells within footers
-                                replace_text(paragraph.runs, target, replace)
+                                replace_text(paragraph.runs, matcher)
                                 # Replace text in hyperlinks within table cells within footers
                                 for link in paragraph._element.xpath(".//w:hyperlink"):
-                                    replace_text(link.xpath("w:r", namespaces=link.nsmap), target, replace)
+                                    replace_text(link.xpath("w:r", namespaces=link.nsmap), matcher)
 
         # Replace text in the main document body
         for paragraph in doc.paragraphs:
             # Replace text in main body paragraphs
-            replace_text(paragraph.runs, target, replace)
+            replace_text(paragraph.runs, matcher)
             # Replace text in hyperlinks within main body paragraphs
             for link in paragraph._element.xpath(".//w:hyperlink"):
-                replace_text(link.xpath("w:r", namespaces=link.nsmap), target, replace)
+                replace_text(link.xpath("w:r", namespaces=link.nsmap), matcher)
     except IndexError:
         warning += 'File is skipped because of an index error!'
 
@@ -346,7 +606,242 @@ def docx_replace(doc, target, replace):
     return paragraph"""
 
 
-def copy_and_replace(zip_in, zip_out):
+class CompressionPolicy:
+    """
+    Chooses the compression of every new or rewritten entry of an output package from its file extension, so media
+    that is already compressed (PNG, JPEG, ...) can be stored instead of being deflated again. Entries copied
+    unchanged keep the compression of the input package.
+
+    Parameters
+    ----------
+    policy: string
+        comma separated extension:method[:level] rules from the config file, e.g. "png:store, xml:deflate:6"
+
+    default: string
+        method[:level] of the entries whose extension has no rule, e.g. "deflate"
+    """
+
+    def __init__(self, policy="", default="deflate"):
+        self.default = self._parse(default)
+        self.extensions = {}
+
+        for rule in policy.split(","):
+            if rule.strip():
+                extension, setting = rule.split(":", 1)
+                self.extensions["." + extension.strip().lower().lstrip(".")] = self._parse(setting)
+
+    @staticmethod
+    def _parse(setting):
+        method, _, level = setting.strip().lower().partition(":")
+        if method not in COMPRESSION_METHODS:
+            raise ValueError(f"Unknown compression method {method}, expected one of {list(COMPRESSION_METHODS)}")
+        compression = COMPRESSION_METHODS[method]
+
+        # The level only applies to deflate, from 1 (fastest) to 9 (smallest)
+        return compression, int(level) if level and compression == ZIP_DEFLATED else None
+
+    def for_entry(self, path):
+        """
+        Returns the compression method and level for an entry of a package
+
+        Parameters
+        ----------
+        path: string
+            name of the entry
+
+        Returns
+        -------
+        compression: tuple
+            zipfile compression method and compression level, None for the zlib default
+        """
+        return self.extensions.get(os.path.splitext(path)[1].lower(), self.default)
+
+
+class ZipRewriter:
+    """
+    Writes an output package from an input package. Every entry is either replaced with new content or passed through
+    unchanged, in the order the entries are written. The names written so far are kept in a set, so checking whether
+    an entry is already in the output doesn't depend on the size of the package, and writing an entry twice raises a
+    ValueError.
+
+    Parameters
+    ----------
+    zip_in: ZipFile obj
+        input package
+
+    file_out: string
+        path to the output package
+
+    policy: CompressionPolicy
+        compression of the entries, every entry is deflated with the default level when not given
+    """
+
+    def __init__(self, zip_in, file_out, policy=None):
+        self.zip_in = zip_in
+        self.zip_out = ZipFile(file_out, "w", ZIP_DEFLATED)
+        self.filename = self.zip_out.filename
+        self.policy = policy if policy is not None else CompressionPolicy()
+        self.written = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, path):
+        return path in self.written
+
+    def close(self):
+        """
+        Writes the central directory and closes the output package
+        """
+        self.zip_out.close()
+
+    def namelist(self):
+        """
+        Returns the names of the entries in the order they have been written
+        """
+        return self.zip_out.namelist()
+
+    def _add(self, path):
+        if path in self.written:
+            raise ValueError(f"{path} has already been written to {self.filename}")
+        self.written.add(path)
+
+        # New entries take the compression of the package, which is set per entry from the policy
+        self.zip_out.compression, self.zip_out.compresslevel = self.policy.for_entry(path)
+
+    def replace(self, path, data):
+        """
+        Writes new content for an entry
+
+        Parameters
+        ----------
+        path: string
+            name of the entry
+
+        data: bytes or string
+            content of the entry
+        """
+        self._add(path)
+        self.zip_out.writestr(path, data)
+
+    def open(self, path, force_zip64=False):
+        """
+        Returns a file object to stream the new content of an entry into
+
+        Parameters
+        ----------
+        path: string
+            name of the entry
+
+        force_zip64: bool
+            has to be set when the entry can grow over 2 GiB
+        """
+        self._add(path)
+        return self.zip_out.open(path, "w", force_zip64=force_zip64)
+
+    def passthrough(self, path):
+        """
+        Copies an entry of the input package unchanged, without decompressing it. The entry keeps the compression
+        method and level of the input package, the policy only applies to the new and rewritten entries.
+
+        Parameters
+        ----------
+        path: string
+            name of the entry in the input package
+        """
+        info = self.zip_in.getinfo(path)
+
+        # Encrypted entries can't be copied as they are
+        if info.flag_bits & 0x1:
+            self.copy_entry(path)
+        else:
+            self.raw_copy(path)
+
+    def raw_copy(self, path):
+        """
+        Copies the compressed bytes of an entry of the input package together with the CRC and the sizes, so the
+        entry isn't decompressed and compressed again. zipfile has no public API to copy raw entries, so this follows
+        what ZipFile.open does when writing an entry and relies on the internals in RAW_COPY_INTERNALS, checked
+        against CPython 3.10 to 3.13. Without them, or when the local file header of the entry doesn't start with
+        its signature, the entry is copied by copy_entry instead.
+
+        Parameters
+        ----------
+        path: string
+            name of the entry in the input package
+        """
+        zip_in, zip_out = self.zip_in, self.zip_out
+        info_in = zip_in.getinfo(path)
+
+        # The compressed data starts after the local file header, its name and extra field can differ from the
+        # ones in the central directory
+        zip_in.fp.seek(info_in.header_offset)
+        file_header = zip_in.fp.read(sizeFileHeader)
+        if (len(file_header) != sizeFileHeader or file_header[:len(stringFileHeader)] != stringFileHeader
+                or not all(hasattr(zip_out, name) for name in RAW_COPY_INTERNALS)):
+            self.copy_entry(path)
+            return
+        file_header = unpack(structFileHeader, file_header)
+        data_offset = (info_in.header_offset + sizeFileHeader + file_header[_FH_FILENAME_LENGTH]
+                       + file_header[_FH_EXTRA_FIELD_LENGTH])
+
+        self._add(path)
+        info_out = ZipInfo(info_in.filename, info_in.date_time)
+        info_out.compress_type = info_in.compress_type
+        info_out.external_attr = info_in.external_attr
+        # The sizes are known, so the entry is written without a data descriptor
+        info_out.flag_bits = info_in.flag_bits & ~0x8
+        info_out.CRC = info_in.CRC
+        info_out.compress_size = info_in.compress_size
+        info_out.file_size = info_in.file_size
+        zip64 = info_out.file_size > ZIP64_LIMIT or info_out.compress_size > ZIP64_LIMIT
+
+        with zip_out._lock:
+            if zip_out._seekable:
+                zip_out.fp.seek(zip_out.start_dir)
+            info_out.header_offset = zip_out.fp.tell()
+            zip_out._writecheck(info_out)
+            zip_out._didModify = True
+            zip_out.fp.write(info_out.FileHeader(zip64))
+
+            zip_in.fp.seek(data_offset)
+            remaining = info_in.compress_size
+            while remaining > 0:
+                chunk = zip_in.fp.read(min(remaining, ZIP_COPY_CHUNK_SIZE))
+                if not chunk:
+                    raise BadZipFile(f"Truncated entry {path}")
+                zip_out.fp.write(chunk)
+                remaining -= len(chunk)
+
+            zip_out.start_dir = zip_out.fp.tell()
+            zip_out.filelist.append(info_out)
+            zip_out.NameToInfo[info_out.filename] = info_out
+
+    def copy_entry(self, path):
+        """
+        Copies an entry of the input package by decompressing it and compressing it again with its compression
+        method, in chunks through the public ZipFile.open. An entry that isn't valid raises the BadZipFile of zipfile.
+
+        Parameters
+        ----------
+        path: string
+            name of the entry in the input package
+        """
+        info_in = self.zip_in.getinfo(path)
+        info_out = ZipInfo(info_in.filename, info_in.date_time)
+        info_out.compress_type = info_in.compress_type
+        info_out.external_attr = info_in.external_attr
+
+        self._add(path)
+        with self.zip_in.open(path) as entry_in, \
+                self.zip_out.open(info_out, "w", force_zip64=info_in.file_size > ZIP64_LIMIT) as entry_out:
+            shutil.copyfileobj(entry_in, entry_out, ZIP_COPY_CHUNK_SIZE)
+
+
+def copy_and_replace(zip_in, zip_out, matcher=None):
     """
     Copies the zip file except for the media folder
 
@@ -355,9 +850,18 @@ def copy_and_replace(zip_in, zip_out):
     zip_in: ZipFile obj
         input ZipFile
 
-    zip_out: ZipFile obj
-        output ZipFile
+    zip_out: ZipRewriter obj
+        output package
+
+    matcher: ReplaceMatcher
+        when given, the text of the document, header and footer parts and the title are replaced while copying
+
+    Returns
+    -------
+    warning: string
+        warning of docx_replace if the text of a part couldn't be replaced
     """
+    warning = ''
     # XML files that contain image crop data
     xml_name_crop = ['header1.xml', 'header2.xml', 'header3.xml']
     # Go over every file in the input document
@@ -365,14 +869,224 @@ def copy_and_replace(zip_in, zip_out):
         already_added = False
         # Check if the path is not in the media folder
         if "media" not in path:
-            file_content = zip_in.read(path)
+            is_text_part = matcher is not None and (
+                search(r'^word/(document|header\d*|footer\d*)\.xml$', path) is not None or path == 'docProps/core.xml')
+            is_crop_part = any(element in path for element in xml_name_crop)
+
+            # Parts that are never rewritten are copied without decompressing them
+            if not is_text_part and not is_crop_part:
+                zip_out.passthrough(path)
+                continue
+
+            # The parts are checked and rewritten in chunks, so they're never held as a whole
+            if matcher is not None and search(r'^word/(document|header\d*|footer\d*)\.xml$', path) is not None:
+                with zip_in.open(path) as part_in:
+                    may_match = matcher.may_match_stream(part_in)
+                # Replace the text straight from the input package, parts without a possible hit are copied as they are
+                if may_match:
+                    with zip_in.open(path) as part_in:
+                        part_warning = _stream_replace_word_part(part_in, zip_out, path, matcher, is_crop_part)
+                    warning = warning or part_warning
+                    continue
+            elif matcher is not None and path == 'docProps/core.xml':
+                with zip_in.open(path) as part_in:
+                    may_match = matcher.may_match_stream(part_in)
+                if may_match:
+                    _replace_core_title(zip_in.read(path), zip_out, path, matcher)
+                    continue
+
+            remove_crop = is_crop_part and _part_contains(zip_in, path, b'srcRect')
+
             # Remove crop from images
-            if any(element in path for element in xml_name_crop):
+            if remove_crop:
                 already_added = _modify_xml_image_crop_fit(zip_in, zip_out, path)
 
             # Copy file into new document
             if not already_added:
-                zip_out.writestr(path, file_content)
+                zip_out.passthrough(path)
+
+    return warning
+
+
+def _part_contains(zip_in, path, data):
+    """
+    Returns whether an entry of the package contains the bytes, the entry is read in chunks
+    """
+    tail = b''
+    with zip_in.open(path) as part_in:
+        while True:
+            chunk = part_in.read(XML_SCAN_CHUNK_SIZE)
+            if not chunk:
+                return False
+            if data in tail + chunk:
+                return True
+            # Keep the end of the chunk in case the bytes are split over two chunks
+            tail = chunk[-(len(data) - 1):]
+
+
+def _stream_replace_word_part(part_in, zip_out, path, matcher, remove_crop=False):
+    """
+    Replaces the text of a WordprocessingML part (document, header or footer) while streaming it from the input
+    to the output ZipFile. Every child of the body (or of the header/footer root) is parsed, rewritten, written and
+    dropped on its own, so the part is never held as a whole tree.
+
+    Parameters
+    ----------
+    part_in: file obj
+        readable part of the input package, e.g. from ZipFile.open
+
+    zip_out: ZipRewriter obj
+        output package
+
+    path: string
+        path of the part inside the zip file
+
+    matcher: ReplaceMatcher
+        compiled replacement rules
+
+    remove_crop: bool
+        removes the crop rectangles of the images as done by _modify_xml_image_crop_fit
+
+    Returns
+    -------
+    warning: string
+        warning of docx_replace if the text of an element couldn't be replaced
+    """
+    warnings = set()
+
+    def rewrite_element(element):
+        warnings.add(_replace_word_element_text(element, matcher))
+
+        # Remove crop from images
+        if remove_crop:
+            for src_rect_element in list(element.iter(f'{DRAWING_NAMESPACE}srcRect')):
+                src_rect_element.getparent().remove(src_rect_element)
+
+    with zip_out.open(path) as part_out:
+        _stream_xml_part(part_in, part_out, rewrite_element, container_tags=(f'{WORD_NAMESPACE}body',))
+
+    return ''.join(sorted(warnings))
+
+
+def _stream_xml_part(part_in, part_out, rewrite_element, container_tags=()):
+    """
+    Streams an XML part from a readable to a writable file object. Every child of the root element (or of one of
+    the container elements) is parsed, passed to rewrite_element, written and dropped on its own, so memory stays
+    flat whatever the size of the part.
+
+    Parameters
+    ----------
+    part_in: file obj
+        readable XML part, e.g. from ZipFile.open
+
+    part_out: file obj
+        writable output, e.g. from ZipFile.open with mode 'w'
+
+    rewrite_element: function
+        called with every streamed element before it is written
+
+    container_tags: tuple
+        tags of elements below the root whose children are streamed instead of the element itself
+    """
+    # Elements whose start tag has been written and whose children are streamed one by one
+    open_elements = []
+    root_nsmap = {}
+
+    part_out.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n')
+
+    for event, element in lxml.etree.iterparse(part_in, events=('start', 'end'), huge_tree=True):
+        if event == 'start':
+            if not open_elements or element.tag in container_tags:
+                if not open_elements:
+                    root_nsmap = element.nsmap
+                # Write the start tag only, the children follow as they are parsed
+                shell = lxml.etree.Element(element.tag, dict(element.attrib), nsmap=element.nsmap)
+                start_tag = lxml.etree.tostring(shell)[:-2] + b'>'
+                if open_elements:
+                    start_tag = _strip_inherited_namespaces(start_tag, root_nsmap)
+                part_out.write(start_tag)
+                open_elements.append(element)
+
+        elif open_elements and element is open_elements[-1]:
+            open_elements.pop()
+            tag_name = lxml.etree.QName(element).localname
+            if element.prefix:
+                tag_name = f'{element.prefix}:{tag_name}'
+            part_out.write(f'</{tag_name}>'.encode())
+
+        elif open_elements and element.getparent() is open_elements[-1]:
+            rewrite_element(element)
+            part_out.write(_strip_inherited_namespaces(lxml.etree.tostring(element, with_tail=False), root_nsmap))
+
+            # Drop the written element to keep memory flat
+            element.clear()
+            element.getparent().remove(element)
+
+
+def _strip_inherited_namespaces(serialized_element, nsmap):
+    """
+    Removes from the start tag of a serialized element the namespace declarations already made by the root element.
+    lxml repeats them on every element serialized on its own.
+    """
+    tag_end = serialized_element.index(b'>')
+    start_tag = serialized_element[:tag_end]
+    for prefix, uri in nsmap.items():
+        if prefix is None:
+            declaration = f' xmlns="{uri}"'.encode()
+        else:
+            declaration = f' xmlns:{prefix}="{uri}"'.encode()
+        start_tag = start_tag.replace(declaration, b'', 1)
+    return start_tag + serialized_element[tag_end:]
+
+
+def _replace_word_element_text(element, matcher):
+    """
+    Replaces the text of every paragraph in a WordprocessingML element, including the paragraphs in tables and text
+    boxes. Like the .//w:t search of docx_replace, every w:t of a paragraph is searched, also inside content controls,
+    tracked insertions, smart tags and simple fields. The text of each hyperlink is replaced on its own, so a hit
+    can't span the link and the text around it, and the w:t of a nested paragraph belong to that paragraph only.
+
+    Returns
+    -------
+    warning: string
+        warning of docx_replace if the text of the element couldn't be replaced
+    """
+    paragraph_tag = f'{WORD_NAMESPACE}p'
+    hyperlink_tag = f'{WORD_NAMESPACE}hyperlink'
+
+    try:
+        for paragraph in element.iter(paragraph_tag):
+            # w:t tags of the paragraph grouped by the hyperlink they're in, None for the text outside of links
+            run_groups = {}
+            for w_t_tag in paragraph.iter(f'{WORD_NAMESPACE}t'):
+                link = None
+                for ancestor in w_t_tag.iterancestors(paragraph_tag, hyperlink_tag):
+                    if ancestor.tag == paragraph_tag:
+                        break
+                    link = ancestor if link is None else link
+                if ancestor is paragraph:
+                    run_groups.setdefault(link, []).append(w_t_tag)
+
+            for w_t_tags in run_groups.values():
+                replace_text(w_t_tags, matcher)
+                # Keep leading and trailing spaces moved between runs by the replacement
+                for w_t_tag in w_t_tags:
+                    if w_t_tag.text and w_t_tag.text != w_t_tag.text.strip():
+                        w_t_tag.set(XML_SPACE, 'preserve')
+    except IndexError:
+        return 'File is skipped because of an index error!'
+
+    return ''
+
+
+def _replace_core_title(xml_data, zip_out, path, matcher):
+    """
+    Replaces the text of the document title in the core properties part
+    """
+    root = lxml.etree.fromstring(xml_data)
+    for title in root.iter(DC_TITLE):
+        title.text = matcher.replace(title.text)
+    zip_out.replace(path, lxml.etree.tostring(root, encoding='UTF-8', xml_declaration=True, standalone=True))
 
 
 """def try_decode(content):
@@ -386,58 +1100,144 @@ def copy_and_replace(zip_in, zip_out):
     return None"""
 
 
-def resize_image(input_image_path, output_image_folder, reference_image_path):
+class ReplacementLogos:
+    """
+    Replacement logo decoded once per run, with the PNG encodings of the logo fitted to each target size kept in a
+    bounded LRU cache. The processors write the encoded bytes straight into the packages.
     """
-    Resize the input image to match the aspect ratio of the reference image, preserving the aspect ratio and avoiding
-    stretching.
+
+    def __init__(self):
+        self.path = None
+        self.logo = None
+        self.max_entries = 0
+        self.encoded = OrderedDict()
+
+    def load(self, logo_path, max_entries):
+        """
+        Decodes the replacement logo, unless it's loaded already
+
+        Parameters
+        ----------
+        logo_path: string
+            path to the replacement logo, the NewLogoPath of the config
+
+        max_entries: int
+            number of encoded sizes kept in the cache
+        """
+        self.max_entries = max_entries
+        if self.path == logo_path:
+            return
+
+        with Image.open(logo_path) as logo:
+            logo.load()
+            self.logo = logo
+        self.path = logo_path
+        self.encoded.clear()
+
+    def fit(self, size, background=(255, 255, 255)):
+        """
+        Returns the replacement logo fitted into the size as PNG bytes. The logo keeps its aspect ratio and is
+        centered on a canvas of the background colour.
+
+        Parameters
+        ----------
+        size: tuple
+            width and height of the replaced image
+
+        background: tuple
+            RGB colour of the canvas
+        """
+        key = (size[0], size[1], background)
+        if key in self.encoded:
+            self.encoded.move_to_end(key)
+            return self.encoded[key]
+
+        ref_width, ref_height = size
+        ref_aspect_ratio = ref_width / ref_height
+        # Calculate the new dimensions for the logo while maintaining aspect ratio
+        input_aspect_ratio = self.logo.width / self.logo.height
+
+        if input_aspect_ratio > ref_aspect_ratio:
+            # The logo is wider, adjust the width to match the reference aspect ratio
+            new_width = ref_width
+            new_height = int(new_width / input_aspect_ratio)
+        else:
+            # The logo is taller, adjust the height to match the reference aspect ratio
+            new_height = ref_height
+            new_width = int(new_height * input_aspect_ratio)
+
+        # Resize the logo with aspect ratio preserved
+        resized_image = self.logo.resize((new_width, new_height))
+        # Create a blank image with the reference aspect ratio and paste the resized logo onto it
+        result_image = Image.new("RGB", (ref_width, ref_height), background)
+        offset = ((ref_width - new_width) // 2, (ref_height - new_height) // 2)
+
+        result_image.paste(resized_image, offset)
+
+        # Encode the result, the least recently used size is dropped when the cache is full
+        encoded_image = BytesIO()
+        result_image.save(encoded_image, format='PNG')
+        self.encoded[key] = encoded_image.getvalue()
+        while len(self.encoded) > self.max_entries:
+            self.encoded.popitem(last=False)
+
+        return self.encoded[key]
+
+
+# Shared by all files of the run, the replacement logo is only decoded once
+replacement_logos = ReplacementLogos()
+
+
+def package_image_size(zip_in, image_location):
+    """
+    Returns the width and height of an image of a package. Only the start of the entry is read, up to the header of
+    the image, the entry isn't extracted and the pixels aren't decoded.
 
     Parameters:
-        input_image_path (str): Path to the input image file.
-        output_image_folder (str): Folder path to save the resized image.
-        reference_image_path (str): Path to the reference image for aspect ratio.
+        zip_in (ZipFile): Input package.
+        image_location (str): Path to the image inside the package.
 
     Returns:
-        new_image_path (str): Path to the new resized image.
+        size (tuple): Width and height of the image in pixels.
     """
-    # Catch any unsupported images
-    try:
-        # Open the reference image to get its aspect ratio
-        with Image.open(reference_image_path) as reference_image:
-            ref_height = reference_image.height
-            ref_width = reference_image.width
-            ref_aspect_ratio = ref_width / ref_height
-
-        new_image_path = f'{output_image_folder}/resized_image_{ref_width}x{ref_height}.png'
-        if not os.path.exists(new_image_path):
-
-            # Open the input image
-            with Image.open(input_image_path) as input_image:
-                # Calculate the new dimensions for the input image while maintaining aspect ratio
-                input_aspect_ratio = input_image.width / input_image.height
-
-                if input_aspect_ratio > ref_aspect_ratio:
-                    # The input image is wider, adjust the width to match the reference aspect ratio
-                    new_width = ref_width
-                    new_height = int(new_width / input_aspect_ratio)
-                else:
-                    # The input image is taller, adjust the height to match the reference aspect ratio
-                    new_height = ref_height
-                    new_width = int(new_height * input_aspect_ratio)
+    with zip_in.open(image_location) as image_file:
+        with Image.open(image_file) as image:
+            return image.size
 
-                # Resize the input image with aspect ratio preserved
-                resized_image = input_image.resize((new_width, new_height))
-                # Create a blank image with the reference aspect ratio and paste the resized image onto it
-                result_image = Image.new("RGB", (ref_width, ref_height), (255, 255, 255))
-                offset = ((ref_width - new_width) // 2, (ref_height - new_height) // 2)
 
-                result_image.paste(resized_image, offset)
+def resize_image(reference_size, config):
+    """
+    Resize the replacement logo to match the aspect ratio of the reference image, preserving the aspect ratio and
+    avoiding stretching.
 
-                # Save the resized image
-                result_image.save(new_image_path)
-    except Exception:
-        new_image_path = ''
+    Parameters:
+        reference_size (tuple): Width and height of the reference image for aspect ratio.
+        config (dict): Dictionary containing information from the config file.
+
+    Returns:
+        image_data (bytes): PNG content of the resized logo, taken from the cache of replacement_logos when that size
+            was already encoded.
+    """
+    replacement_logos.load(config['NewLogoPath'], int(config.get('ReplacementLogoCacheSize', '64')))
 
-    return new_image_path
+    return replacement_logos.fit(reference_size)
+
+
+def header_image_locations(zip_in):
+    """
+    Returns the images the headers of a package refer to, media/[image] per image and one list per header
+    relationship part, like header2.xml.rels
+
+    Parameters
+    ----------
+    zip_in: ZipFile obj
+        input ZipFile
+    """
+    # pylint: disable=W1401
+    # Disable error from using \S\s in a binary string which is needed for regex
+    return [[image_location[image_location.find(b"media"):-1].decode("ascii")
+             for image_location in findall(b'Target="media[\S\s]*?"', zip_in.read(file))]
+            for file in zip_in.namelist() if "header" in file and "rel" in file]
 
 
 def replace_header_images(zip_in, zip_out, config, note):
@@ -449,8 +1249,8 @@ def replace_header_images(zip_in, zip_out, config, note):
     zip_in: ZipFile obj
         input ZipFile
 
-    zip_out: ZipFile obj
-        output ZipFile
+    zip_out: ZipRewriter obj
+        output package
 
     config: dictionary
         dict containing information from the config file
@@ -471,55 +1271,43 @@ def replace_header_images(zip_in, zip_out, config, note):
     """
     warning = ""
     images_replaced_path = []
-    # Check every filename for header --> can contain information about images in the header
-    # Possible filenames: header2.xml.rels, header3.xml.rels
-    for file in zip_in.namelist():
-        if "header" in file and "rel" in file:
-            # pylint: disable=W1401
-            # Disable error from using \S\s in a binary string which is needed for regex
-            # Get every target image
-            image_locations = findall(b'Target="media[\S\s]*?"', zip_in.read(file))
-
-            if len(image_locations) > 1:
-                warning = "Warning: Multiple images found in header"
-            for image_location in image_locations:
-                image_location = image_location[image_location.find(b"media"):-1].decode("ascii")
-                # Get the full path: Path in target string is just media/[image]
-                # Path is either word/media/[image] or xls/media/[image]
-                try:
-                    # Skip image if not in the right format
-                    if image_location.endswith('.wmf'):
-                        continue
-
-                    header_image_path = f"{config['filetype']}/{image_location}"
-
-                    # Add replaced image path for output
-                    images_replaced_path.append(header_image_path)
-
-                    # Extract image from the zip object
-                    zip_image_location = 'word/' + image_location
-                    zip_in.extract(zip_image_location, path=config['ImagesFolder'])
-
-                    # Resize image to fit in the extracted image's container
-                    new_image_path = resize_image(config['NewLogoPath'], config['ImagesFolder'],
-                                                  config['ImagesFolder'] + zip_image_location)
-
-                    # Delete extracted image
-                    os.remove(config['ImagesFolder'] + zip_image_location)
-
-                    if header_image_path not in zip_out.namelist():
-                        zip_out.write(new_image_path, header_image_path)
-                        log_information['LegacyText'] += f"Replaced header image {header_image_path},"
-                except KeyError:
-                    # Filetype is not in config
-                    # Get path to the image by looping over the entire content
-                    for location in zip_in.namelist():
-                        if image_location in location:
-                            if image_location not in zip_out.namelist():
-                                print(f"Replaced header image at {location}")
-                                zip_out.write(new_image_path, location)
-                                log_information['LegacyText'] += f"Replaced header image {location},"
-                            break
+    # Every target image of the header relationship parts
+    for image_locations in header_image_locations(zip_in):
+        if len(image_locations) > 1:
+            warning = "Warning: Multiple images found in header"
+        for image_location in image_locations:
+            # Get the full path: Path in target string is just media/[image]
+            # Path is either word/media/[image] or xls/media/[image]
+            try:
+                # Skip image if not in the right format
+                if image_location.endswith('.wmf'):
+                    continue
+
+                header_image_path = f"{config['filetype']}/{image_location}"
+
+                # Add replaced image path for output
+                images_replaced_path.append(header_image_path)
+
+                # Read the size of the image from its header in the zip object
+                image_size = package_image_size(zip_in, header_image_path)
+
+                # Resize image to fit in the image's container
+                new_image_data = resize_image(image_size, config)
+
+                if header_image_path not in zip_out:
+                    zip_out.replace(header_image_path, new_image_data)
+                    log_information['LegacyText'] += f"Replaced header image {header_image_path},"
+            except KeyError:
+                # Filetype is not in config
+                # Get path to the image by looping over the entire content
+                for location in zip_in.namelist():
+                    if image_location in location:
+                        if location not in zip_out:
+                            print(f"Replaced header image at {location}")
+                            new_image_data = resize_image(package_image_size(zip_in, location), config)
+                            zip_out.replace(location, new_image_data)
+                            log_information['LegacyText'] += f"Replaced header image {location},"
+                        break
 
     return note, warning, images_replaced_path
 
@@ -547,37 +1335,30 @@ def check_header_images(zip_in, config, note):
     alternative_old_logo_found = False
     # Found image at expected path but with different size
     # Check if image is in header
-    for file in zip_in.namelist():
-        if "header" in file and "rel" in file:
-            # pylint: disable=W1401
-            # Disable error from using \S\s in a binary string which is needed for regex
-            # Get every target image
-            image_locations = findall(b'Target="media[\S\s]*?"', zip_in.read(file))
-            for image_location in image_locations:
-                image_location = image_location[image_location.find(
-                    b"media"):-1].decode("ascii")
-                # Format image_location to the full path
-                try:
-                    image_location = f'{config["filetype"]}/{image_location}'
-                except KeyError:
-                    # filetype not in config; cant automatically create full image path
-                    # Check every location to get the full path
-                    for path in zip_in.namelist():
-                        if image_location in path:
-                            image_location = path
-                            break
-
-                alternative_old_logo_size = zip_in.getinfo(
-                    image_location).file_size
-                note += f'''Found alternative image in {image_location
-                } with size {alternative_old_logo_size} bytes, '''
-                alternative_old_logo_found = True
+    for image_locations in header_image_locations(zip_in):
+        for image_location in image_locations:
+            # Format image_location to the full path
+            try:
+                image_location = f'{config["filetype"]}/{image_location}'
+            except KeyError:
+                # filetype not in config; cant automatically create full image path
+                # Check every location to get the full path
+                for path in zip_in.namelist():
+                    if image_location in path:
+                        image_location = path
+                        break
+
+            alternative_old_logo_size = zip_in.getinfo(
+                image_location).file_size
+            note += f'''Found alternative image in {image_location
+            } with size {alternative_old_logo_size} bytes, '''
+            alternative_old_logo_found = True
     if not alternative_old_logo_found:
         note += "No image in header,"
     return note
 
 
-def place_logo_header(zip_in, zip_out, config):
+def place_logo_header(zip_in, zip_out, config, add_to_catalog=True):
     """
     Places the new BH logo in the Word document
 
@@ -586,12 +1367,15 @@ def place_logo_header(zip_in, zip_out, config):
     zip_in: ZipFile obj
         input ZipFile
 
-    zip_out: ZipFile obj
-        output ZipFile
+    zip_out: ZipRewriter obj
+        output package
 
     config: dictionary
         dict containing information from the config file
 
+    add_to_catalog: bool
+        adds the header images to the logo catalog, False when scan_word_headers added them already
+
     Returns
     -------
     status: string
@@ -632,7 +1416,7 @@ def place_logo_header(zip_in, zip_out, config):
     num_files = len(files_in_folder)
 
     # Add header image(s) to the catalog (if they're unique)
-    if config['CompareLogoByPixels'] and num_files > 0:
+    if config['CompareLogoByPixels'] and add_to_catalog and num_files > 0:
         for image_location in header_images[file_name]:
             # Add image to the catalog
             add_image_to_catalog(zip_in, image_location, config)
@@ -642,7 +1426,8 @@ def place_logo_header(zip_in, zip_out, config):
 
 def add_image_to_catalog(zip_in, image_location, config):
     """
-    Extracts the image from a zipfile path, and adds it to the catalog of logos if it's unique.
+    Reads the image from a zipfile path, and adds it to the catalog of logos if it's unique. In a worker process of
+    the pool the image is kept in catalog_images instead, for the main process to add it.
 
     Parameters
     ----------
@@ -652,51 +1437,187 @@ def add_image_to_catalog(zip_in, image_location, config):
     image_location: string
         path to the image inside the zipfile
 
+    config: dictionary
+        dict containing information from the config file
+    """
+    image_data = zip_in.read(image_location)
+    if catalog_images is not None:
+        catalog_images.append((image_location, image_data))
+    else:
+        add_data_to_catalog(image_data, image_location, config)
+
+
+def add_data_to_catalog(image_data, image_location, config):
+    """
+    Adds an image to the catalog of logos if it's unique and not transparent
+
+    Parameters
+    ----------
+    image_data: bytes
+        content of the image
+
+    image_location: string
+        path to the image inside the zipfile, its extension is kept for the logo
+
     config: dictionary
         dict containing information from the config file
     """
     global different_logos_found
-    # Extract image
-    zip_in.extract(image_location, path=config["BetweenFolder"])
-    file_extension = os.path.splitext(config["BetweenFolder"] + image_location)[1]
+    # The image is decoded once for the transparency check, the comparison and the catalog
+    probe = ImageProbe(image_data)
+    file_extension = os.path.splitext(image_location)[1]
     logo_is_present = False
     image_is_transparent = False
 
     # Check if image is transparent and omit it if it is
     try:
-        image = Image.open(config["BetweenFolder"] + image_location)
-        if image.mode == 'RGBA':
-            image_is_transparent = all(pixel[3] == 0 for pixel in image.getdata())
-        try:
-            image.close()
-        except Exception as e:
-            print(f'Error when closing the image. Error: {e}')
+        image_is_transparent = probe.alpha_empty()
     except Exception as e:
         print(f'Error occurred when checking image transparency. Error: {e}')
 
     if not image_is_transparent:
-        # Get all logo paths from the catalog
-        logo_locations = os.listdir(config["FoundLogosFolder"])
-
-        # Cycle through the entire catalog and check if header image is already present
-        for logo in logo_locations:
-            # Compare header image with logo
-            logo_is_present = compare_images(config["BetweenFolder"] + image_location,
-                                             config["FoundLogosFolder"] + logo)
-            if logo_is_present:
-                break
+        # Check if header image is already present in the catalog
+        logo_is_present = find_matching_logo(probe, config, catalog_check=True) is not None
 
-        # Add image to the logo catalog folder
+        # Add image to the logo catalog folder, numbered after the logos of earlier runs kept in the folder
         if not logo_is_present:
-            different_logos_found += 1
-            renamed_path = f'{config["BetweenFolder"]}{os.path.dirname(image_location)}/logo_' \
-                           f'{different_logos_found}{file_extension}'
-            os.rename(config["BetweenFolder"] + image_location, renamed_path)
-            shutil.move(renamed_path, config["FoundLogosFolder"])
+            different_logos_found = max(different_logos_found, logo_catalog.last_number) + 1
+            logo = f'logo_{different_logos_found}{file_extension}'
+            # An existing logo is never overwritten
+            with open(os.path.join(config["FoundLogosFolder"], logo), 'xb') as logo_file:
+                logo_file.write(probe.data)
+            logo_catalog.add(logo, probe)
+
+
+def replace_body_images(zip_in, zip_out, header_images_paths, config):
+    """
+    Compares the images of a Word package, except the header images, with the logo catalog and replaces the similar
+    ones with the resized replacement logo
+
+    Parameters
+    ----------
+    zip_in: ZipFile obj
+        input ZipFile
+
+    zip_out: ZipRewriter obj
+        output package
+
+    header_images_paths: list
+        paths to the header images, they are not compared
+
+    config: dictionary
+        dict containing information from the config file
+    """
+    # Get all image locations without the header
+    image_locations = [item for item in zip_in.namelist() if '/media/' in item]
+
+    # Check that header images exist
+    if len(header_images_paths) != 0:
+        # Remove from image_location header paths
+        for header_image in header_images_paths:
+            if header_image in image_locations:
+                image_locations.remove(header_image)
+
+    # Compare all images with the logo catalog
+    for image in image_locations:
+        # Images already written, like the header images found by name, are kept
+        if image in zip_out:
+            continue
+
+        # Images are read from the package instead of being extracted
+        probe = ImageProbe(zip_in.read(image))
+
+        # Replace image if similar to a logo
+        if find_matching_logo(probe, config) is not None:
+            log_information['Logo'] = 'Body Logo Found'
+            log_information['NumLogos'] += 1
+            zip_image_location = f'{os.path.dirname(image)}/{os.path.basename(image)}'
+
+            # Resize logo from catalog
+            logo_replacement_data = resize_image(probe.size(), config)
+
+            # Add similar images to zip_out
+            zip_out.replace(zip_image_location, logo_replacement_data)
 
-        # Remove zip images empty base directory
-        zip_image_base_directory = image_location.split('/')[0]
-        shutil.rmtree(config["BetweenFolder"] + zip_image_base_directory)
+            # Add note
+            log_information['LegacyText'] += f'Replaced image: {image} '
+
+
+def scan_word_headers(file_in, config):
+    """
+    Read-only header phase of a Word file: finds the images of its headers and adds them to the logo catalog without
+    writing the file. The file is written once in the body image phase by process_file_word, which replaces the
+    text, the header images and the body images together.
+
+    Parameters
+    ----------
+    file_in: string
+        the path to the input file
+
+    config: dictionary
+        dict containing information from the config file
+    """
+    header_image_paths = []
+
+    with ZipFile(file_in) as zip_in:
+        # Same header images as replace_header_images replaces
+        if "true" in config["ReplaceHeaderImage"].lower():
+            for image_locations in header_image_locations(zip_in):
+                for image_location in image_locations:
+                    # Skip image if not in the right format
+                    if not image_location.endswith('.wmf'):
+                        header_image_paths.append(f"{config['filetype']}/{image_location}")
+
+        # Add header image(s) to the catalog (if they're unique)
+        if any(name.startswith('word/media') for name in zip_in.namelist()):
+            for image_location in header_image_paths:
+                add_image_to_catalog(zip_in, image_location, config)
+
+    # Only scanned files are rewritten in the body image phase
+    header_images[os.path.basename(file_in)] = header_image_paths
+    scanned_word_files.add(os.path.basename(file_in))
+    log_information['Logo'] = "Header Logo Found" if len(header_image_paths) > 0 else "No Header Logo"
+    log_information['Notes'] = 'File scanned - header images'
+
+
+def single_word_rewrite(config):
+    """
+    Returns whether the header phase only scans the .docx files, so they're written once in the body image phase
+
+    Parameters
+    ----------
+    config: dictionary
+        dict containing information from the config file
+    """
+    return bool(config['CompareLogoByPixels']) and "true" in config.get("SingleWordRewrite", "false").lower()
+
+
+def body_phase_files(config):
+    """
+    Returns the files of the body image phase: the .docx files scanned in the header phase, rewritten once from the
+    input folder, followed by the files of the HeaderImageReplacedFoler with the Word files first
+
+    Parameters
+    ----------
+    config: dictionary
+        dict containing information from the config file
+
+    Returns
+    -------
+    files: list
+        file name, input path and whether it's rewritten from the input folder, for every file
+    """
+    files = []
+    if single_word_rewrite(config):
+        files = [(file, os.path.join(config["InputFolder"], file), True)
+                 for file in sorted(os.listdir(config["InputFolder"]))
+                 if file in scanned_word_files]
+
+    # Sort files to process Word files first before other file types
+    sorted_files = sorted(os.listdir(config["HeaderImageReplacedFoler"]),
+                          key=lambda x: (not x.lower().endswith((".docx", ".doc", ".docm")), x))
+
+    return files + [(file, os.path.join(config["HeaderImageReplacedFoler"], file), False) for file in sorted_files]
 
 
 def place_logo_body(file_in, file_out, config):
@@ -710,81 +1631,32 @@ def place_logo_body(file_in, file_out, config):
     if file_in.endswith('.docx'):
         doc = Document(file_path)
         header_images_paths = header_images[new_file_path]
-        doc.save((config["BetweenFolder"]) + new_file_path)
+        package = intermediate_package(config)
+        doc.save(package)
     elif file_in.endswith(skip_file_formats):
         # Move file and finish executing function
         os.rename(file_in, file_out)
 
         return True
+    else:
+        # The header phase only leaves Word files and the skipped formats in the HeaderImageReplacedFoler
+        raise ValueError(f'Unsupported file type for the body image replacement: {file_in}')
 
     # Open input document and new document
-    with ZipFile(open((config["BetweenFolder"]) + new_file_path, "rb")) as zip_in:
-        with ZipFile(file_out, "w", ZIP_DEFLATED) as zip_out:
+    with package, ZipFile(package) as zip_in:
+        with ZipRewriter(zip_in, file_out, config["CompressionPolicy"]) as zip_out:
 
             # Copy contents to zip_out
             for path in zip_in.namelist():
                 if 'media' not in path:
-                    file_content = zip_in.read(path)
                     # Copy file into new document
-                    zip_out.writestr(path, file_content)
+                    zip_out.passthrough(path)
 
-            # Get all image locations without the header
-            image_locations = [item for item in zip_in.namelist() if '/media/' in item]
-
-            # Check that header images exist
-            if len(header_images_paths) != 0:
-                # Remove from image_location header paths
-                for header_image in header_images_paths:
-                    if header_image in image_locations:
-                        image_locations.remove(header_image)
-
-            # Extract all images besides the header logo
-            zip_in.extractall(config["BetweenFolder"], members=image_locations)
-
-            # Get all logo paths from the catalog
-            logo_locations = os.listdir(config["FoundLogosFolder"])
-
-            # Check that there's any images
-            if len(image_locations) != 0:
-                # Compare all images with the logo catalog
-                for image in image_locations:
-                    for logo in logo_locations:
-                        similar = compare_images(config["FoundLogosFolder"] + logo, config["BetweenFolder"] + image)
-
-                        # Replace image if similar
-                        if similar:
-                            log_information['Logo'] = 'Body Logo Found'
-                            log_information['NumLogos'] += 1
-                            zip_image_location = f'{os.path.dirname(image)}/{os.path.basename(image)}'
-
-                            # Resize logo from catalog
-                            logo_replacement_path = resize_image(config['NewLogoPath'], config['ImagesFolder'],
-                                                                 config["BetweenFolder"] + image)
-
-                            # Add similar images to zip_out
-                            zip_out.write(logo_replacement_path, zip_image_location, compress_type=ZIP_DEFLATED)
-
-                            # Add note
-                            log_information['LegacyText'] += f'Replaced image: {image} '
-
-                            break
-
-            if len(image_locations) != 0:
-                zip_image_base_directory = image.split('/')[0]
-            elif len(header_images_paths) != 0:
-                zip_image_base_directory = header_images_paths[0].split('/')[0]
-            else:
-                zip_image_base_directory = None
-
-            # Delete extracted images
-            if zip_image_base_directory is not None:
-                if os.path.exists(config["BetweenFolder"] + zip_image_base_directory):
-                    shutil.rmtree(config["BetweenFolder"] + zip_image_base_directory)
+            # Replace the body images similar to a logo
+            replace_body_images(zip_in, zip_out, header_images_paths, config)
 
             # Add missing images
             add_missing_images(zip_in, zip_out)
-    # Remove file from betweenFolder
-    os.remove((config["BetweenFolder"]) + new_file_path)
     # Remove file from original location
     os.remove(file_in)
 
@@ -941,7 +1813,46 @@ def convert_to_pdf(file_in, config, word, excel, power_point):
         presentation.close()
 
 
-def process_file_word(file_in, file_out, config):
+def intermediate_package(config):
+    """
+    Returns an empty file object for a package that is only needed while the current file is processed. It is held in
+    memory and only written to a temporary file in the BetweenFolder when it grows over IntermediatePackageMaxMB
+
+    Parameters
+    ----------
+    config: dictionary
+        content of the configuration file as dictionary with the tag as
+        key and the information as value
+
+    Returns
+    -------
+    package: SpooledTemporaryFile
+        file object to save the package into, it is deleted when closed
+    """
+    max_size = int(config.get("IntermediatePackageMaxMB", "64")) * 1024 * 1024
+
+    return SpooledTemporaryFile(max_size=max_size, dir=config["BetweenFolder"])
+
+
+def process_file_word(file_in, file_out, config, body_images=False):
+    """
+    Replaces the text and the header images of a Word file
+
+    Parameters
+    ----------
+    file_in: string
+        the path to the input file
+
+    file_out: string
+        the path to the output file
+
+    config: dictionary
+        dict containing information from the config file
+
+    body_images: bool
+        also replaces the body images similar to a logo of the catalog, for the Word files scanned by
+        scan_word_headers. The file is then written once instead of being rewritten by place_logo_body.
+    """
     # log_information['Inputfile'] = file_in
     file_path = file_in
     file_out_path = file_out
@@ -955,31 +1866,42 @@ def process_file_word(file_in, file_out, config):
         file_path = convert_file(file_path, FILE_FORMAT_DOCX)
 
         # Update file_out_path to contain the new extension
-        file_out_path = f'{os.path.dirname(file_out)}\{os.path.basename(file_path)}'
+        file_out_path = os.path.join(os.path.dirname(file_out), os.path.basename(file_path))
 
-    doc = Document(file_path)
-    prop = doc.core_properties
-    for replace_duo in config["ReplaceString"]:
-        log_information['Warning'] = docx_replace(doc, replace_duo[0], replace_duo[1])
-        prop.title = prop.title.replace(replace_duo[0], replace_duo[1])
+    # Stream the text parts straight from the input file into the output file instead of building the python-docx
+    # object model and saving it as an intermediate package
+    if "true" in config.get("StreamWordXml", "false").lower():
+        package = open(file_path, "rb")
+        matcher = config["ReplaceMatcher"]
+    else:
+        doc = Document(file_path)
+        prop = doc.core_properties
+        log_information['Warning'] = docx_replace(doc, config["ReplaceMatcher"])
+        prop.title = config["ReplaceMatcher"].replace(prop.title)
 
-    new_file_path = os.path.basename(file_path)
-    doc.save((config["BetweenFolder"]) + new_file_path)
+        package = intermediate_package(config)
+        matcher = None
+        doc.save(package)
 
     # Open input document and new document
-    with ZipFile(open((config["BetweenFolder"]) + new_file_path, "rb")) as zip_in:
-        with ZipFile(file_out_path, "w", ZIP_DEFLATED) as zip_out:
-            # copy document and replace content
-            copy_and_replace(zip_in, zip_out)
+    with package, ZipFile(package) as zip_in:
+        with ZipRewriter(zip_in, file_out_path, config["CompressionPolicy"]) as zip_out:
+            # copy document and replace content, the streamed text parts report the warning of docx_replace
+            text_warning = copy_and_replace(zip_in, zip_out, matcher)
+            if matcher is not None:
+                log_information['Warning'] = text_warning
             # check for logo
-            status, note, warning = place_logo_header(zip_in, zip_out, config)
+            status, note, warning = place_logo_header(zip_in, zip_out, config, add_to_catalog=not body_images)
+            # Compare the body images with the catalog built by the header scan
+            if body_images:
+                replace_body_images(zip_in, zip_out, header_images[os.path.basename(file_out_path)], config)
             # Add missing images
             add_missing_images(zip_in, zip_out)
 
-    # Remove file from betweenFolder
-    os.remove((config["BetweenFolder"]) + new_file_path)
-
-    log_information['Notes'] = 'File processed successfully - text & header'
+    if body_images:
+        log_information['Notes'] = 'File processed successfully - text, header & body image'
+    else:
+        log_information['Notes'] = 'File processed successfully - text & header'
 
     # log.write(f"{file_in};{status};-;{note};{text_note};{warning}\n")
 
@@ -1003,8 +1925,8 @@ def copy_and_replace_content_excel(file_in, file_out, config):
     new_file_path = os.path.basename(file_in)
 
     # Open the input Zip file for reading and the output Zip file for writing
-    with ZipFile(open(config['InputFolder'] + '\\' + new_file_path, 'rb')) as zip_in:
-        with ZipFile(file_out, 'w') as zip_out:
+    with ZipFile(open(os.path.join(config['InputFolder'], new_file_path), 'rb')) as zip_in:
+        with ZipRewriter(zip_in, file_out, config['CompressionPolicy']) as zip_out:
 
             # Copy the content of the input file except the media folder and xml files containing strings to be replaced
             # on the worksheets
@@ -1013,108 +1935,212 @@ def copy_and_replace_content_excel(file_in, file_out, config):
                     if 'worksheets' in path or 'sharedStrings' in path:
                         if path.endswith('xml'):
                             continue
-                    file_content = zip_in.read(path)
-                    zip_out.writestr(path, file_content)
+                    zip_out.passthrough(path)
 
-            # Extract all images from the workbook stored in the media folder
+            # Get all images of the workbook stored in the media folder
             image_locations = [img_loc for img_loc in zip_in.namelist() if '/media/' in img_loc]
-            # Extract all images
-            zip_in.extractall(config['BetweenFolder'], members=image_locations)
-
-            # Get all logo paths from the catalog
-            logo_locations = os.listdir(config['FoundLogosFolder'])
 
             # Check if there are any images in the presentation
             if len(image_locations) > 0:
                 # Compare all images with the logo catalog
                 for image_location in image_locations:
-                    for logo_location in logo_locations:
-                        # Do similarity check
-                        similarity = compare_images(
-                            image_path1=config['FoundLogosFolder'] + logo_location,  # Path for the first image
-                            image_path2=config['BetweenFolder'] + image_location  # Path for the second image
+                    # Images are read from the workbook instead of being extracted
+                    probe = ImageProbe(zip_in.read(image_location))
+
+                    # If the image is similar to a logo, replace it
+                    if find_matching_logo(probe, config) is not None:
+                        log_information['Logo'] = 'Logo Found'
+                        log_information['NumLogos'] += 1
+                        zip_image_location = f'{os.path.dirname(image_location)}/{os.path.basename(image_location)}'
+
+                        # Resize the logo from catalog
+                        resized_image_data = resize_image(
+                            reference_size=probe.size(),  # Size of the replaced image
+                            config=config  # NewLogoPath is the logo to resize
                         )
 
-                        # If images are similar, replace them
-                        if similarity:
-                            log_information['Logo'] = 'Logo Found'
-                            log_information['NumLogos'] += 1
-                            zip_image_location = f'{os.path.dirname(image_location)}/{os.path.basename(image_location)}'
+                        # Add new resized image to archive under the original image file name
+                        zip_out.replace(zip_image_location, resized_image_data)
+
+                        log_information['LegacyText'] += f'Replaced image: {image_location}, '
+
+                    else:  # If no similarity detected add the image file to the output archive
+                        if image_location not in zip_out:
+                            zip_out.passthrough(image_location)
+
+            # Perform text replacement in the xml files
+            _replace_text_excel(zip_in=zip_in, zip_out=zip_out, config=config)
+
+            log_information['Notes'] = 'File processed successfully'
+            # log.write(f'{file_in};{logo};{str(num_logos)};{status};{note};{warning}\n')
+
+
+def _replace_text_excel(zip_in, zip_out, config):
+    """
+    Finds elements in the input files that contain outdated text and replaces them
+
+    Parameters
+    ----------
+    zip_in: Input Zip archive
+    zip_out: Output package (ZipRewriter)
+    config: dict - Configuration file
+
+    Returns None
+    -------
+    """
+
+    # Iterate through all files in the input archive
+    for path in zip_in.namelist():
+        # If worksheets or the sharedStrings XML files are present in the archive
+        if '/worksheets/' in path or 'sharedStrings' in path:
+            if path.endswith('xml'):
+
+                # Parts without a possible hit are copied as they are, without parsing them
+                with zip_in.open(path) as part_in:
+                    may_match = config['ReplaceMatcher'].may_match_stream(part_in)
+                if not may_match:
+                    zip_out.passthrough(path)
+                    continue
+
+                # Stream the sharedStrings XML file, it can be too large to be parsed as a whole
+                if 'sharedStrings' in path:
+                    _stream_replace_shared_strings(zip_in=zip_in, zip_out=zip_out, path=path, config=config)
+                else:
+                    # In the worksheet XML only the 'headerFooter' element might contain strings that need to be
+                    # replaced
+                    _stream_replace_worksheet(zip_in=zip_in, zip_out=zip_out, path=path, config=config)
+
+
+def _stream_replace_worksheet(zip_in, zip_out, path, config):
+    """
+    Copies a worksheet XML file from the input archive to the output archive in chunks. The cell data is passed
+    through as bytes, only the small 'headerFooter' element is parsed to replace the strings of the odd, even and
+    first page headers and footers.
+
+    Parameters
+    ----------
+    zip_in: Input Zip archive
+    zip_out: Output package (ZipRewriter)
+    path: string
+        Path to the worksheet XML file in the archive
+    config: dict - Configuration file
+
+    Returns None
+    -------
+    """
+
+    root_start_tag = None  # Start tag of the worksheet element holding the namespace declarations
+    pending = b''  # Bytes read but not written yet
+    end_of_file = False
+
+    with zip_in.open(path) as part_in, zip_out.open(path) as part_out:
+        while not end_of_file:
+            chunk = part_in.read(WORKSHEET_CHUNK_SIZE)
+            end_of_file = not chunk
+            pending += chunk
+
+            if root_start_tag is None:
+                root_tag_match = search(rb'<(?![?!])[^>]*>', pending)
+                if root_tag_match is None and not end_of_file:
+                    continue
+                root_start_tag = root_tag_match.group() if root_tag_match is not None else b''
+
+            # The worksheet and each of its custom sheet views can hold a 'headerFooter' element
+            while True:
+                start_match = search(rb'<(?:[\w.-]+:)?headerFooter[\s/>]', pending)
+                if start_match is None:
+                    # Keep the end of the chunk in case the start tag is split over two chunks
+                    keep = 0 if end_of_file else 32
+                    part_out.write(pending[:len(pending) - keep])
+                    pending = pending[len(pending) - keep:]
+                    break
+
+                # Write the cell data in front of the element as it is
+                part_out.write(pending[:start_match.start()])
+                pending = pending[start_match.start():]
+
+                start_tag_end = pending.find(b'>')
+                if start_tag_end != -1 and pending[start_tag_end - 1:start_tag_end] == b'/':
+                    # Empty element without headers or footers
+                    part_out.write(pending[:start_tag_end + 1])
+                    pending = pending[start_tag_end + 1:]
+                    continue
+
+                end_match = search(rb'</(?:[\w.-]+:)?headerFooter\s*>', pending)
+                if end_match is None:
+                    # Wait for the rest of the element
+                    if end_of_file:
+                        part_out.write(pending)
+                        pending = b''
+                    break
+
+                part_out.write(_replace_header_footer_block(pending[:end_match.end()], root_start_tag, config))
+                pending = pending[end_match.end():]
+
+        part_out.write(pending)
+
 
-                            # Resize the logo from catalog
-                            resized_image_path = resize_image(
-                                input_image_path=config['NewLogoPath'],  # Path to 'replacementLogo.png'
-                                output_image_folder=config['ImagesFolder'],  # Path to save resized image
-                                reference_image_path=config['BetweenFolder'] + image_location  # Path to reference image
-                            )
+def _replace_header_footer_block(block, root_start_tag, config):
+    """
+    Replaces the strings of a serialized worksheet 'headerFooter' element
 
-                            # Add new resized image to archive under the original image file name
-                            zip_out.write(resized_image_path, zip_image_location, compress_type=ZIP_DEFLATED)
+    Parameters
+    ----------
+    block: bytes
+        Serialized 'headerFooter' element
+    root_start_tag: bytes
+        Start tag of the worksheet element, needed to resolve the namespaces of the block
+    config: dict - Configuration file
 
-                            log_information['LegacyText'] += f'Replaced image: {image_location}, '
+    Returns bytes of the element with the strings replaced
+    -------
+    """
 
-                            break  # Break out of the inner loop
+    # Leave the block as it is if none of the strings to be replaced can occur in it
+    if not config['ReplaceMatcher'].may_match(block):
+        return block
 
-                    else:  # If no similarity detected add the image file to the output archive
-                        if image_location not in zip_out.namelist():
-                            image_data = zip_in.read(image_location)
-                            zip_out.writestr(image_location, image_data)
+    # Wrap the block into the worksheet element to parse it with the same namespaces
+    root_name = search(rb'<([^\s/>]+)', root_start_tag).group(1)
+    wrapper = lxml.etree.fromstring(root_start_tag + block + b'</' + root_name + b'>')
+    header_footer = wrapper[0]
 
-            # Perform text replacement in the xml files
-            _replace_text_excel(zip_in=zip_in, zip_out=zip_out, config=config)
+    # Find the odd, even and first page header and footer elements
+    string_elements = [element for element in header_footer
+                       if isinstance(element.tag, str) and lxml.etree.QName(element).localname in HEADER_FOOTER_TAGS]
+    _replace_string_excel(elements=string_elements, config=config)
 
-            log_information['Notes'] = 'File processed successfully'
-            # log.write(f'{file_in};{logo};{str(num_logos)};{status};{note};{warning}\n')
+    return _strip_inherited_namespaces(lxml.etree.tostring(header_footer, with_tail=False), wrapper.nsmap)
 
 
-def _replace_text_excel(zip_in, zip_out, config):
+def _stream_replace_shared_strings(zip_in, zip_out, path, config):
     """
-    Finds elements in the input files that contain outdated text and replaces them
+    Replaces the strings of the sharedStrings XML file while streaming it from the input archive straight into the
+    output archive entry, one 'si' (string item) element at a time
 
     Parameters
     ----------
     zip_in: Input Zip archive
-    zip_out: Output Zip archive
+    zip_out: Output package (ZipRewriter)
+    path: string
+        Path to the sharedStrings XML file in the archive
     config: dict - Configuration file
 
     Returns None
     -------
     """
 
-    prefix_map = {
-        'xmlns': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
-    }  # Mapping of namespaces in the XML
-
-    # Iterate through all files in the input archive
-    for path in zip_in.namelist():
-        # If worksheets or the sharedStrings XML files are present in the archive
-        if '/worksheets/' in path or 'sharedStrings' in path:
-            if path.endswith('xml'):
-
-                xml_tree = zip_in.read(path)  # Open and read in the XML file from path
-                root = lxml.etree.fromstring(xml_tree)  # Parse the XML tree
-
-                # Variable to hold xml elements that will need to be string validated
-                string_elements = []
+    text_tag = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}t'
 
-                if 'sharedStrings' in path:
-                    # Find all t - 'text' tags in the sharedStrings XML file
-                    string_elements = root.findall('.//xmlns:t', namespaces=prefix_map)
-                else:
-                    # In the worksheet XML find 'oddHeader' and 'oddFooter' elements that might contain strings that
-                    # need to be replaced
-                    odd_headers = root.findall('.//xmlns:oddHeader', namespaces=prefix_map)
-                    string_elements.extend(odd_headers)
-                    odd_footers = root.findall('.//xmlns:oddFooter', namespaces=prefix_map)
-                    string_elements.extend(odd_footers)
+    def rewrite_string_item(string_item):
+        # Find all t - 'text' tags in the string item and pass them to the replace string function
+        _replace_string_excel(elements=list(string_item.iter(text_tag)), config=config)
 
-                # If elements with text were found pass them to the replace string function
-                if string_elements is not None:
-                    _replace_string_excel(elements=string_elements, config=config)
+    # Allow a large entry to grow past the ZIP64 limit through the longer replacement strings
+    force_zip64 = zip_in.getinfo(path).file_size > ZIP64_LIMIT // 2
 
-                # Write the XML with replaced text to the output file at the path
-                replaced_text_xml = lxml.etree.tostring(root, encoding='UTF-8')
-                zip_out.writestr(path, replaced_text_xml)
+    with zip_in.open(path) as part_in, zip_out.open(path, force_zip64=force_zip64) as part_out:
+        _stream_xml_part(part_in, part_out, rewrite_string_item)
 
 
 def _replace_string_excel(elements, config):
@@ -1133,10 +2159,9 @@ def _replace_string_excel(elements, config):
     """
 
     for element in elements:
-        for value in config['ReplaceString']:
-            replaced_value = element.text.replace(value[0], value[1])
-            if replaced_value != element.text:
-                element.text = replaced_value
+        replaced_value = config['ReplaceMatcher'].replace(element.text)
+        if replaced_value != element.text:
+            element.text = replaced_value
 
 
 def process_file_excel(file_in, file_out, config):
@@ -1197,13 +2222,10 @@ def _pptx_text_replace(text_frame, config):
     ------
     """
 
-    # Iterate through each replacement definitions in the config file
-    for replace_duo in config['ReplaceString']:
-        # Iterate through each 'paragraph' block in the text frame
-        for paragraph in text_frame.paragraphs:
-            # Call the 'replace_text' function passing in the 'runs' from the paragraph, the target and replacement
-            # strings
-            replace_text(runs=paragraph.runs, target=replace_duo[0], replace=replace_duo[1])
+    # Iterate through each 'paragraph' block in the text frame
+    for paragraph in text_frame.paragraphs:
+        # Call the 'replace_text' function passing in the 'runs' from the paragraph and the compiled replacement rules
+        replace_text(runs=paragraph.runs, matcher=config['ReplaceMatcher'])
 
 
 def process_file_powerpoint(file_in, file_out, config):
@@ -1229,94 +2251,67 @@ def process_file_powerpoint(file_in, file_out, config):
 
     prs = Presentation(file_path)  # Instantiate the Presentation object using the python-pptx module
 
-    pptx_replace(prs=prs, config=config)  # Replace text in presentation slides and notes
-
-    new_file_path = os.path.basename(file_path)
-    prs.save((config['BetweenFolder']) + new_file_path)
-
-    # Open the input document to access the underlying XML files for the PowerPoint presentation
-    with ZipFile(open(config['BetweenFolder'] + new_file_path, 'rb')) as zip_in:
-        with ZipFile(file_out_path, 'w', ZIP_DEFLATED) as zip_out:
-
-            # Copy the content of the input file to the output file except the media folder and slide xml files
-            for path in zip_in.namelist():
-                if 'media' not in path:
-                    if '/slides/' in path:
-                        if path.endswith('.xml'):
-                            continue
-                    file_content = zip_in.read(path)
-                    zip_out.writestr(path, file_content)
-
-            # Extract all images from the presentation stored in the media folder
-            image_locations = [img_loc for img_loc in zip_in.namelist() if '/media/' in img_loc]
-            # Extract all images
-            zip_in.extractall(config['BetweenFolder'], members=image_locations)
+    # Every stage works on the same in-memory presentation, which is saved once at the end
 
-            # Get all logo paths from the catalog
-            logo_locations = os.listdir(config['FoundLogosFolder'])
+    pptx_replace(prs=prs, config=config)  # Replace text in presentation slides and notes
 
-            # Check if there are any images in the presentation
-            if len(image_locations) > 0:
-                # Compare all images with the logo catalog
-                for image_location in image_locations:
-                    # print(image_location)
-                    for logo_location in logo_locations:
-                        # Do similarity check
-                        similarity = compare_images(
-                            image_path1=config['FoundLogosFolder'] + logo_location,  # Path for the first image
-                            image_path2=config['BetweenFolder'] + image_location  # Path for the second image
-                        )
+    _replace_presentation_images(prs=prs, config=config)  # Replace the images similar to a logo in the catalog
 
-                        # If images are similar, replace them
-                        if similarity:
-                            log_information['Logo'] = 'Logo Found'
-                            log_information['NumLogos'] += 1
-                            zip_image_location = f'{os.path.dirname(image_location)}/{os.path.basename(image_location)}'
+    for slide in prs.slides:
+        # For each slide in the PowerPoint file hide the background graphics
+        disable_background_graphics(slide=slide)
 
-                            # Resize the logo from catalog
-                            resized_image_path = resize_image(
-                                input_image_path=config['NewLogoPath'],  # Path to 'replacementLogo.png'
-                                output_image_folder=config['ImagesFolder'],  # Path to save resized image
-                                reference_image_path=config['BetweenFolder'] + image_location  # Path to reference image
-                            )
+    insert_replacement_image_to_slide(prs=prs, config=config)  # Insert the BakerHughes logo in
 
-                            # Add new resized image to archive under the original image file name
-                            zip_out.write(resized_image_path, zip_image_location, compress_type=ZIP_DEFLATED)
+    change_bg_color(prs=prs)  # Change the background color of the slides in the presentation
 
-                            log_information['LegacyText'] += f'Replaced image: {image_location}, '
+    prs.save(file_out_path)  # Save the presentation
 
-                            break  # Break out of the inner loop
+    log_information['Notes'] = 'File processed successfully'
 
-                    else:  # If no similarity detected add the image file to the output archive
-                        if image_location not in zip_out.namelist():
-                            image_data = zip_in.read(image_location)
-                            zip_out.writestr(image_location, image_data)
+    return True
 
-                # Get base directory where images are located
-                zip_image_base_directory = image_location.split('/')[0]
 
-                # Delete extracted images following iteration
-                if os.path.exists(config['BetweenFolder'] + zip_image_base_directory):
-                    shutil.rmtree(config['BetweenFolder'] + zip_image_base_directory)
+def _replace_presentation_images(prs, config):
+    """
+    Compares the images of the presentation with the logo catalog and replaces the similar ones with the resized
+    replacement logo
 
-            for path in zip_in.namelist():
-                if '/slides/' in path and path.endswith('.xml'):
-                    # For each slide in the PowerPoint file hide the background graphics
-                    disable_background_graphics(zip_in=zip_in, zip_out=zip_out, xml_path=path)
+    Parameters
+    ----------
+    prs: Presentation object
+    config: Configuration file
 
-    os.remove(config['BetweenFolder'] + new_file_path)  # Remove the file from the 'between' folder
+    Returns None
+    -------
+    """
 
-    prs = Presentation(file_out_path)  # Load in the presentation from the output file
+    # Get all images of the presentation stored in the media folder
+    image_parts = [part for part in prs.part.package.iter_parts() if '/media/' in part.partname]
 
-    insert_replacement_image_to_slide(prs=prs, config=config)  # Insert the BakerHughes logo in
+    # Check if there are any images in the presentation
+    if len(image_parts) > 0:
+        # Compare all images with the logo catalog
+        for image_part in image_parts:
+            image_location = image_part.partname[1:]  # Path inside the package, e.g. ppt/media/image1.png
+            probe = ImageProbe(image_part.blob)
 
-    change_bg_color(prs=prs)  # Change the background color of the slides in the presentation
+            # If the image is similar to a logo, replace it
+            if find_matching_logo(probe, config) is not None:
+                log_information['Logo'] = 'Logo Found'
+                log_information['NumLogos'] += 1
 
-    prs.save(file_out_path)  # Save the presentation
+                # Resize the logo from catalog
+                resized_image_data = resize_image(
+                    reference_size=probe.size(),  # Size of the replaced image
+                    config=config  # NewLogoPath is the logo to resize
+                )
 
-    log_information['Notes'] = 'File processed successfully'
+                # Replace the image part content under the original image file name, through the blob setter of the
+                # python-pptx parts
+                image_part.blob = resized_image_data
 
-    return True
+                log_information['LegacyText'] += f'Replaced image: {image_location}, '
 
 
 def _check_background_color(slide_layout):
@@ -1410,7 +2405,7 @@ def _create_copyright_element():
     """
 
     # String representation of the XML element
-    xml_string = """<p:sp>
+    xml_string = f"""<p:sp {nsdecls('p', 'a')}>
                         <p:nvSpPr>
                             <p:cNvPr id="999" name="Copyright Text"/>
                             <p:cNvSpPr txBox="1"/>
@@ -1444,9 +2439,9 @@ def _create_copyright_element():
                         </p:txBody>
                     </p:sp>"""
 
-    parser = lxml.etree.XMLParser(encoding='UTF-8', recover=True, remove_blank_text=True)  # XML parser object
-    # Parse the string definition and create the XML element
-    copyright_xml_element = xml.etree.ElementTree.fromstring(xml_string, parser=parser)
+    # Parse the string definition and create the XML element with the python-pptx parser, so it behaves like the
+    # other shapes of the slide
+    copyright_xml_element = parse_xml(xml_string)
 
     return copyright_xml_element  # Return the XML element
 
@@ -1652,23 +2647,19 @@ def get_element_location(element_node, prefix_map):
         return None
 
 
-def disable_background_graphics(zip_in, zip_out, xml_path):
+def disable_background_graphics(slide):
     """
     Disables the background graphics on the slide and adds copyright information
 
     Parameters
     ----------
-    zip_in: input ZipFile object
-    zip_out: output ZipFile object
-    xml_path: string
-        Path to the PowerPoint slide xml file
+    slide: Slide object
 
     Returns None
     -------
     """
 
-    xml_tree = zip_in.open(xml_path).read()  # Open and read in the xml file from the path
-    root = lxml.etree.fromstring(xml_tree)  # Parse the tree
+    root = slide.element  # Root element of the slide xml
 
     if root.attrib.get('showMasterSp') is None:  # If 'showMasterSp' attribute is not present in the xml file
         root.attrib['showMasterSp'] = '0'  # Set the showMasterSp attribute to 0 to hide background graphics
@@ -1679,10 +2670,6 @@ def disable_background_graphics(zip_in, zip_out, xml_path):
     # sp_tree.insert(-1, xml_element)  # Append the xml element to the spTree
     sp_tree.append(xml_element)  # Append the xml element to the spTree
 
-    # Write the updated xml file to the output file
-    modified_xml = lxml.etree.tostring(root, encoding='utf-8', xml_declaration=True)
-    zip_out.writestr(xml_path, modified_xml)
-
 
 def convert_to_pdf_2(file_path, file_name, config):
     cv_pdf_2_docx = ConverterPdf2Docx(file_path)
@@ -1692,8 +2679,8 @@ def convert_to_pdf_2(file_path, file_name, config):
 
 def process_file_pdf(file_in, file_out, config):
     file_path = file_in
-    pdfs.append(file_path.split('\\')[-1])
-    file_name = file_path.split('\\')[-1][0:-4]
+    pdfs.append(os.path.basename(file_path))
+    file_name = os.path.basename(file_path)[0:-4]
     file_out_path = file_out.replace('.pdf', '.docx')
 
     if file_path.endswith('.pdf'):
@@ -1758,6 +2745,8 @@ def process_file(file_in, file_out, config):
     file_type = None
     file_extension = pathlib.Path(file_in).suffix
     match file_extension:
+        case '.docx' if single_word_rewrite(config):
+            scan_word_headers(file_in, config)
         case '.doc' | '.docx' | '.docm':
             process_file_word(file_in, file_out, config)
         case '.xlsx' | '.xls':
@@ -1783,17 +2772,17 @@ def add_missing_images(zip_in, zip_out):
     zip_in : ZipFile
         The input ZipFile object from which to extract the image filenames.
 
-    zip_out : ZipFile
-        The output ZipFile object where the missing images will be added.
+    zip_out : ZipRewriter
+        The output package where the missing images will be added.
     """
     # Get a list of image filenames from zip_in
-    image_files = [item.filename for item in zip_in.infolist() if '/media/' in item.filename]
+    # Same condition as the copy loops skipping the media, packages not saved by Office keep media/ at the root
+    image_files = [item.filename for item in zip_in.infolist() if 'media' in item.filename]
 
     # Check if the image already exists in zip_out, and if not, add it
     for image_file in image_files:
-        if image_file not in zip_out.namelist():
-            image_data = zip_in.read(image_file)
-            zip_out.writestr(image_file, image_data)
+        if image_file not in zip_out:
+            zip_out.passthrough(image_file)
 
 
 def convert_file(file, new_file_format):
@@ -1899,6 +2888,10 @@ def main():
 
         process_file_failure_count = 0
 
+        # More than one worker processes the files in a pool of processes, 0 uses one per CPU
+        workers = int(config.get("Workers", "1")) or os.cpu_count()
+        header_tasks = []
+
         # PDF conversion is currently NOT required for file processing
         """pdf_conversion = False
         if "true" in config["PDF"].lower():
@@ -1941,7 +2934,7 @@ def main():
                 file_out = os.path.join(output_folder, file)
 
                 # Get the document number for the current file being processed
-                doc_num = file_in.split('\\')[-1]
+                doc_num = os.path.basename(file_in)
 
                 # If the document number is present in the 'ProcessedFolder', the file has been already re-branded
                 if doc_num in os.listdir(config['ProcessedFolder']):
@@ -1976,6 +2969,15 @@ def main():
                 config["LegacyBHLogoPath_formatted"] = config["LegacyBHLogoPath"].format(
                     filetype=config["filetype"])
 
+                # With a pool the files are processed once all of them are checked
+                if workers > 1:
+                    if os.path.getsize(file_in) != 0:
+                        header_tasks.append(('header', file, file_in, file_out, None))
+                    else:
+                        print(f"File skipped because it's empty: {file}")
+                        log.write(f"{file_in};-;-;File skipped because it's empty!;-;-\n")
+                    continue
+
                 # Process the file if it's not empty
                 print(f"File {file_counter}/{file_count} -- Processing {file}")
                 try:
@@ -2012,6 +3014,9 @@ def main():
 
                     # End timer and output time
                     print(f"Converting took {time() - start_converting_time:.3f} seconds")"""
+
+            if len(header_tasks) > 0:
+                process_file_failure_count += run_header_tasks(header_tasks, config, workers, log, file_count)
         else:
             print("Specify an existing input folder containing the documents and an output folder")
 
@@ -2021,18 +3026,14 @@ def main():
             file_counter = 1
             file_count = len(os.listdir(config['InputFolder']))
             body_replace_failure_count = 0
+            body_tasks = []
             global file_run_times
 
-            # Sort files to process Word files first before other file types
-            sorted_files = sorted(os.listdir(config["HeaderImageReplacedFoler"]),
-                                  key=lambda x: (not x.lower().endswith((".docx", ".doc", ".docm")), x))
-
-            # Loop over every file in the directory
-            for file_body in sorted_files:
+            # Loop over the scanned Word files and every file in the HeaderImageReplacedFoler
+            for file_body, file_in, rewrite in body_phase_files(config):
                 process_time = time()
 
-                # Create input and output path and start file processing
-                file_in = os.path.join(config["HeaderImageReplacedFoler"], file_body)
+                # Create output path and start file processing
                 file_out = os.path.join(config["OutputFolder"], file_body)
 
                 # Get the current filetype
@@ -2044,10 +3045,23 @@ def main():
                     log.write(f"{file_in};-;-;Filetype not supported;-;-\n")
                     continue
 
-                # Replace image inside body
+                # With a pool the body images are replaced once all files are checked
+                if workers > 1:
+                    body_tasks.append(('rewrite' if rewrite else 'body', file_body, file_in, file_out,
+                                       header_images.get(file_body)))
+                    continue
+
+                # Replace image inside body, the scanned Word files are written with their text and header images
                 print(f'File {file_counter}/{file_count} -- Replacing body image for: {file_in}')
                 try:
-                    place_logo_body(file_in, file_out, config)
+                    if rewrite:
+                        config["OldLogoPath_formatted"] = config["OldLogoPath"].format(filetype=config["filetype"])
+                        config["LegacyBHLogoPath_formatted"] = config["LegacyBHLogoPath"].format(
+                            filetype=config["filetype"])
+                        log_information['Inputfile'] = file_in
+                        process_file_word(file_in, file_out, config, body_images=True)
+                    else:
+                        place_logo_body(file_in, file_out, config)
                     if file_in.endswith('.docx'):
                         log_information['Time'] = str(time() - process_time)
                         log.write(';'.join([str(value) for key, value in log_information.items() if key]) + '\n')
@@ -2061,26 +3075,18 @@ def main():
                 # Remove file from headerImageReplaced folder
                 # os.remove(file_in)
 
-                # If the current input file originally was 'pdf', convert it back to pdf
-                if file_in.split('\\')[-1].replace('.docx', '.pdf') in pdfs:
-                    file_out_pdf = file_out.replace('.docx', '.pdf')  # Update the output path with 'pdf' extension
-                    try:
-                        ConvertDocx2Pdf(file_out, file_out_pdf)  # Convert docx to pdf
-                        os.remove(file_out)  # Remove the docx copy from the output folder
-                    except Exception as e:
-                        log.write(f'{file_out};-;-;Failed converting to PDF;Error{e};-\n')
-                        continue
-
-                    # Increment PDF processing timer
-                    file_run_times['pdf'] = file_run_times['pdf'] + (time() - process_time)
-                else:
-                    # Increment word processing timer
-                    file_run_times['word'] = file_run_times['word'] + (time() - process_time)
+                # Convert back to PDF and increment the processing timers
+                finish_body_file(file_in, file_out, time() - process_time, log)
+
+            if len(body_tasks) > 0:
+                body_replace_failure_count += run_body_tasks(body_tasks, config, workers, log, file_count)
 
             print(
                 f"All done! \nThe script ran for {strftime('%H:%M:%S', gmtime(time() - script_run_time))} seconds"
                 f"\nReplacing the files' body images took: {strftime('%H:%M:%S', gmtime(time() - body_image_replace))} "
-                f"seconds\nTotal image comparisons: {image_comparisons:,}\nProcessed file failed: "
+                f"seconds\nTotal image comparisons: {image_comparisons:,}\nCandidate logos rejected by size: "
+                f"{cascade_counts['size']:,}, colour: {cascade_counts['colour']:,}, hash: {cascade_counts['hash']:,}, "
+                f"pixels: {cascade_counts['pixels']:,}\nProcessed file failed: "
                 f"{process_file_failure_count}\nBody image replacement fails count:{body_replace_failure_count}\n\nTime "
                 f"breakdown:\nWord: {format_time(file_run_times['word'])}\nExcel: "
                 f"{format_time(file_run_times['excel'])}\nPowerPoint: {format_time(file_run_times['powerpoint'])}\nPDF: "
@@ -2140,18 +3146,760 @@ def _modify_xml_image_crop_fit(zip_in, zip_out, xml_file_path):
     modified_xml_data = lxml.etree.tostring(root, encoding='utf-8', xml_declaration=True)
 
     # Replace the original file inside the zip_in with the updated content
-    zip_out.writestr(xml_file_path, modified_xml_data)
+    zip_out.replace(xml_file_path, modified_xml_data)
 
     return True
 
 
-def compare_images(image_path1, image_path2):
+class BKTree:
+    """
+    Burkhard-Keller tree over the perceptual hashes of the logo catalog. The Hamming distance is a metric, so a search
+    only visits the subtrees whose edge distance is within the search radius of the distance to the node, instead of
+    every logo.
+    """
+
+    def __init__(self):
+        # Nodes are [hash, items, {distance: child node}]
+        self.root = None
+
+    @staticmethod
+    def distance(hash1, hash2):
+        """
+        Returns the Hamming distance between two hashes
+        """
+        return bin(hash1 ^ hash2).count('1')
+
+    def add(self, image_hash, item):
+        """
+        Adds an item under its hash, items with equal hashes share a node
+        """
+        if self.root is None:
+            self.root = [image_hash, [item], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = self.distance(image_hash, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            if distance not in node[2]:
+                node[2][distance] = [image_hash, [item], {}]
+                return
+            node = node[2][distance]
+
+    def search(self, image_hash, max_distance):
+        """
+        Returns the items whose hash is at most max_distance away, closest first
+        """
+        results = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node_hash, items, children = nodes.pop()
+            distance = self.distance(image_hash, node_hash)
+            if distance <= max_distance:
+                results += [(distance, item) for item in items]
+            # Triangle inequality: only children within the radius of this distance can hold a result
+            nodes += [child for edge, child in children.items() if abs(edge - distance) <= max_distance]
+
+        return [item for _, item in sorted(results)]
+
+
+def perceptual_hash(image):
+    """
+    Returns the 64 bit difference hash (dHash) of an image: the image is reduced to 9x8 grey pixels and every bit
+    tells whether a pixel is brighter than its left neighbour. Visually similar images have hashes with a small
+    Hamming distance.
+
+    Parameters
+    ----------
+    image: Image obj
+        decoded PIL image
+
+    Returns
+    -------
+    image_hash: int
+        difference hash of the image
+    """
+    # Alpha is ignored like in compare_images, which compares the RGB channels
+    pixels = np.asarray(image.convert("RGB").convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def reduce_image(image, size):
+    """
+    Returns the image reduced by the largest whole factor that keeps it at least twice as large as size, so the
+    conversion and the resampling to size don't work on the full resolution
+
+    Parameters
+    ----------
+    image: Image obj
+        decoded PIL image
+
+    size: tuple
+        width and height the image is resampled to afterwards
+    """
+    factor = min(image.width // (2 * size[0]), image.height // (2 * size[1]))
+    if factor < 2:
+        return image
+    if image.mode not in REDUCIBLE_MODES:
+        image = image.convert("RGB")
+
+    return image.reduce(factor)
+
+
+def thumbnail_array(image, size):
+    """
+    Returns the image reduced to the canonical comparison size as an RGB array. The array is signed, so the
+    differences of two thumbnails don't wrap around.
+
+    Parameters
+    ----------
+    image: Image obj
+        decoded PIL image
+
+    size: tuple
+        width and height of the thumbnail, the ComparisonSize of the config
+    """
+    return np.asarray(reduce_image(image, size).convert("RGB").resize(size), dtype=np.int16)
+
+
+class ImageProbe:
+    """
+    Image of a package, opened once and shared by the transparency check, the logo comparison, the catalog and the
+    resizing of the replacement logo. The header is read when the image is first used and the pixels are only decoded
+    when a check needs them; the content hash, the transparency, the perceptual hash and the thumbnails are computed
+    on first use and kept. The perceptual hash and the thumbnails are computed from a reduced decode of the image, so
+    the cascade doesn't decode the full resolution of a JPEG. Errors of PIL are raised to the caller, like when
+    opening the image directly.
+    """
+
+    def __init__(self, image_data):
+        self.data = image_data
+        self._image = None
+        self._loaded = False
+        self._digest = None
+        self._alpha_empty = None
+        self._reduced = {}
+        self._hashes = {}
+        self._thumbnails = {}
+
+    def image(self):
+        """
+        Returns the opened PIL image, its size and mode are known without decoding the pixels
+        """
+        if self._image is None:
+            self._image = Image.open(BytesIO(self.data))
+
+        return self._image
+
+    def decoded(self):
+        """
+        Returns the PIL image with its pixels decoded
+        """
+        image = self.image()
+        image.load()
+        self._loaded = True
+
+        return image
+
+    def reduced(self, size):
+        """
+        Returns the image decoded and reduced for the comparison at that size, at least twice as large as size. A JPEG
+        that isn't decoded yet is drafted at a smaller scale on its own, the full image stays available in decoded
+        """
+        if size not in self._reduced:
+            if self._loaded:
+                image = self._image
+            else:
+                image = Image.open(BytesIO(self.data))
+                # Only JPEG decoders support drafts, other formats are decoded at full resolution
+                image.draft('RGB', (2 * size[0], 2 * size[1]))
+                image.load()
+            self._reduced[size] = reduce_image(image, size)
+
+        return self._reduced[size]
+
+    def size(self):
+        """
+        Returns the width and height of the image, read from its header
+        """
+        return self.image().size
+
+    def mode(self):
+        """
+        Returns the PIL mode of the image, read from its header
+        """
+        return self.image().mode
+
+    def digest(self):
+        """
+        Returns the SHA-256 of the content of the image
+        """
+        if self._digest is None:
+            self._digest = sha256(self.data).hexdigest()
+
+        return self._digest
+
+    def alpha_empty(self):
+        """
+        Returns whether the image is RGBA and fully transparent, from the extrema of the alpha channel
+        """
+        if self._alpha_empty is None:
+            self._alpha_empty = self.mode() == 'RGBA' and self.decoded().getchannel('A').getextrema() == (0, 0)
+
+        return self._alpha_empty
+
+    def perceptual_hash(self, size):
+        """
+        Returns the perceptual hash of the image, from the image reduced for the comparison at that size
+        """
+        if size not in self._hashes:
+            self._hashes[size] = perceptual_hash(self.reduced(size))
+
+        return self._hashes[size]
+
+    def thumbnail(self, size):
+        """
+        Returns the thumbnail of the image for the comparison at that size
+        """
+        if size not in self._thumbnails:
+            self._thumbnails[size] = thumbnail_array(self.reduced(size), size)
+
+        return self._thumbnails[size]
+
+
+class LogoCatalog:
+    """
+    Logos of the FoundLogosFolder, decoded once per run and kept in memory together with the BK-tree of their
+    perceptual hashes and their thumbnails stacked in one array. The Word, Excel and PowerPoint paths share it and
+    add_image_to_catalog adds new logos in place, so the folder is only read when the catalog is loaded.
+
+    An image is similar to a logo if its mean pixel deviation is below the tolerance of the logo, DEVIATION_THRESHOLD
+    unless dedupe_logo_catalog.py merged near-duplicates into it. The larger tolerances are measured on the thumbnails,
+    they don't cover compare_images at the resolution of the image.
+    """
+
+    def __init__(self):
+        self.folder = None
+        self.size = None
+        self.logos = {}
+        self.digests = set()
+        self.tree = BKTree()
+        self.positions = {}
+        self.thumbnails = []
+        self.aspect_ratios = []
+        self.hashes = {}
+        self.tolerances = {}
+        self.hash_margins = {}
+        self.aspect_margins = {}
+        self.last_number = 0
+        self.stack = None
+        self.colours = None
+        self.tolerance_array = None
+        self.aspect_margin_array = None
+        self._version = None
+
+    def load(self, logo_folder, size):
+        """
+        Decodes the logos of the folder, unless the catalog already holds them with thumbnails of that size
+
+        Parameters
+        ----------
+        logo_folder: string
+            path to the FoundLogosFolder
+
+        size: tuple
+            width and height of the thumbnails, the ComparisonSize of the config
+        """
+        if self.folder == logo_folder and self.size == size:
+            return
+
+        self.folder = logo_folder
+        self.size = size
+        self.logos = {}
+        self.digests = set()
+        self.tree = BKTree()
+        self.positions = {}
+        self.thumbnails = []
+        self.aspect_ratios = []
+        self.hashes = {}
+        self.tolerances = {}
+        self.hash_margins = {}
+        self.aspect_margins = {}
+        self.last_number = 0
+        self.stack = None
+        self.colours = None
+        self.tolerance_array = None
+        self.aspect_margin_array = None
+        self._version = None
+
+        tolerances = {}
+        tolerances_path = os.path.join(logo_folder, CATALOG_TOLERANCES_FILE)
+        if os.path.exists(tolerances_path):
+            with open(tolerances_path, encoding='utf-8') as tolerances_file:
+                tolerances = json.load(tolerances_file)
+
+        for logo in os.listdir(logo_folder):
+            if logo == CATALOG_TOLERANCES_FILE:
+                continue
+            # Logos that can't be decoded keep their number as well
+            self.last_number = max(self.last_number, logo_number(logo))
+            logo_tolerances = tolerances.get(logo, {})
+            if not isinstance(logo_tolerances, dict):
+                # Files written before the margins hold the deviation tolerance alone
+                logo_tolerances = {'tolerance': logo_tolerances}
+            with open(os.path.join(logo_folder, logo), 'rb') as logo_file:
+                self.add(logo, ImageProbe(logo_file.read()), **logo_tolerances)
+
+    def add(self, logo, probe, tolerance=DEVIATION_THRESHOLD, hash_margin=0, aspect_margin=1.0):
+        """
+        Decodes a logo and adds it to the catalog. A name already in the catalog raises a ValueError, so the logos,
+        their positions in the stack and their tolerances stay aligned.
+
+        Parameters
+        ----------
+        logo: string
+            file name of the logo in the FoundLogosFolder
+
+        probe: ImageProbe obj
+            probe of the logo file
+
+        tolerance: float
+            mean pixel deviation below which an image is similar to the logo
+
+        hash_margin: int
+            bits the perceptual hash of an image may differ beyond LogoHashDistance
+
+        aspect_margin: float
+            factor the aspect ratio of an image may differ beyond LogoAspectRatio
+        """
+        # The name is the key of the logo in every structure of the catalog
+        if logo in self.logos:
+            raise ValueError(f"{logo} is already in the logo catalog")
+        self.last_number = max(self.last_number, logo_number(logo))
+
+        try:
+            image = probe.decoded()
+            image_hash = probe.perceptual_hash(self.size)
+            thumbnail = probe.thumbnail(self.size)
+        except Exception:
+            # Logos that can't be decoded never match in compare_images either
+            return
+
+        self.logos[logo] = image
+        self.digests.add(probe.digest())
+        self.tree.add(image_hash, logo)
+        self.hashes[logo] = image_hash
+        self.positions[logo] = len(self.thumbnails)
+        self.thumbnails.append(thumbnail)
+        self.aspect_ratios.append(image.width / image.height)
+        self.tolerances[logo] = tolerance
+        self.hash_margins[logo] = hash_margin
+        self.aspect_margins[logo] = aspect_margin
+        # Stacked again on the next match, the version is computed again on the next lookup
+        self.stack = None
+        self.colours = None
+        self.tolerance_array = None
+        self.aspect_margin_array = None
+        self._version = None
+
+    def _stack(self):
+        """
+        Stacks the thumbnails, their mean colours and the tolerances of the logos, if they changed since the last
+        comparison
+        """
+        if self.stack is None:
+            self.stack = np.stack(self.thumbnails)
+            self.colours = self.stack.mean(axis=(1, 2))
+            self.tolerance_array = np.asarray([self.tolerances[logo] for logo in self.logos])
+            self.aspect_margin_array = np.asarray([self.aspect_margins[logo] for logo in self.logos])
+
+    def logo_tolerances(self, logo):
+        """
+        Returns the tolerances of a logo of the catalog, with the keys of DEFAULT_TOLERANCES
+        """
+        return {'tolerance': self.tolerances[logo], 'hash_margin': self.hash_margins[logo],
+                'aspect_margin': self.aspect_margins[logo]}
+
+    def version(self, config):
+        """
+        Returns a hash of the content of the catalog and the comparison settings, verdicts cached for another version
+        may be outdated. The hash is kept until a logo is added or the settings change, so a lookup doesn't depend on
+        the size of the catalog.
+
+        Parameters
+        ----------
+        config: dictionary
+            dict containing information from the config file
+        """
+        settings = (f'{COMPARISON_VERSION};{config.get("LogoHashDistance", "10")};'
+                    f'{config.get("LogoAspectRatio", "3")};{self.size};{config.get("CatalogComparison", "fixed")};'
+                    f'{config.get("ThumbnailThreshold")};')
+
+        if self._version is None or self._version[0] != settings:
+            tolerances = ''.join(sorted(f'{logo}:{tolerance};' for logo, tolerance in self.tolerances.items()
+                                        if tolerance != DEVIATION_THRESHOLD))
+            tolerances += ''.join(sorted(f'{logo}:{self.hash_margins[logo]}:{self.aspect_margins[logo]};'
+                                         for logo in self.logos
+                                         if self.hash_margins[logo] != 0 or self.aspect_margins[logo] != 1.0))
+            version = sha256((settings + tolerances + ''.join(sorted(self.digests))).encode()).hexdigest()
+            self._version = (settings, version)
+
+        return self._version[1]
+
+    def candidates(self, image_hash, max_distance):
+        """
+        Returns the names of the logos whose hash is at most max_distance plus their hash_margin away from the image
+        hash, closest first
+        """
+        logos = self.tree.search(image_hash, max_distance + max(self.hash_margins.values(), default=0))
+
+        return [logo for logo in logos
+                if BKTree.distance(image_hash, self.hashes[logo]) <= max_distance + self.hash_margins[logo]]
+
+    def cascade(self, probe, config):
+        """
+        Rejects the logos of the catalog that can't be similar to the image in stages, from the cheapest test to the
+        most expensive one: the aspect ratio, read from the image header before the pixels are decoded, the mean
+        colour of the thumbnails and the distance of the perceptual hashes. The logos rejected by each stage are
+        counted in cascade_counts.
+
+        Parameters
+        ----------
+        probe: ImageProbe obj
+            probe of the image, decoded by the colour stage if it's reached
+
+        config: dictionary
+            dict containing information from the config file
+
+        Returns
+        -------
+        logos: list
+            names of the remaining logos for the pixel comparison, closest hash first
+        """
+        width, height = probe.size()
+        if len(self.logos) == 0 or width == 0 or height == 0:
+            return []
+
+        self._stack()
+        remaining = np.arange(len(self.thumbnails))
+
+        # Logos are scaled but rarely cropped or stretched much, the aspect ratios of similar images stay close
+        aspect_ratio = width / height
+        logo_aspect_ratios = np.asarray(self.aspect_ratios)
+        quotients = np.maximum(logo_aspect_ratios / aspect_ratio, aspect_ratio / logo_aspect_ratios)
+        remaining = reject_candidates('size', remaining,
+                                      quotients <= float(config.get("LogoAspectRatio", "3")) * self.aspect_margin_array)
+        if len(remaining) == 0:
+            return []
+
+        try:
+            thumbnail = probe.thumbnail(self.size)
+            image_hash = probe.perceptual_hash(self.size)
+        except Exception:
+            # Images that can't be decoded never match
+            return []
+
+        # The mean pixel deviation is at least the deviation of the mean colours, so this stage only rejects logos
+        # the pixel comparison would reject as well
+        colour_deviations = np.abs(self.colours[remaining] - thumbnail.mean(axis=(0, 1))).mean(axis=1)
+        remaining = reject_candidates('colour', remaining, colour_deviations < self.tolerance_array[remaining])
+        if len(remaining) == 0:
+            return []
+
+        # Only the logos with a close perceptual hash can be similar
+        remaining = set(remaining.tolist())
+        logos = [logo for logo in self.candidates(image_hash, int(config.get("LogoHashDistance", "10")))
+                 if self.positions[logo] in remaining]
+        cascade_counts['hash'] += len(remaining) - len(logos)
+
+        return logos
+
+    def match(self, probe, logos=None):
+        """
+        Compares an image with several logos of the catalog in one NumPy operation on their thumbnails
+
+        Parameters
+        ----------
+        probe: ImageProbe obj
+            probe of the decoded image
+
+        logos: list
+            names of the logos to compare with, the whole catalog when not given
+
+        Returns
+        -------
+        logo: string
+            name of the logo with the lowest deviation relative to its tolerance, None if there are no logos to compare
+            with
+
+        deviation: float
+            mean absolute pixel deviation between the thumbnails of the image and that logo
+        """
+        logos = list(self.logos) if logos is None else logos
+        if len(logos) == 0:
+            return None, float('inf')
+
+        self._stack()
+        positions = [self.positions[logo] for logo in logos]
+        deviations = np.abs(self.stack[positions] - probe.thumbnail(self.size)).mean(axis=(1, 2, 3))
+        best = int(np.argmin(deviations - self.tolerance_array[positions]))
+
+        return logos[best], float(deviations[best])
+
+    def clusters(self, distance):
+        """
+        Groups the near-duplicate logos of the catalog. The logos are taken oldest first, each one joins the cluster
+        of the closest representative if the deviation of their thumbnails is below distance, otherwise it represents
+        a new cluster. The mean pixel deviation of the thumbnails satisfies the triangle inequality, so an image whose
+        thumbnail is similar to a member is within the tolerance of the member plus its deviation from the
+        representative. The same holds for the Hamming distance of the hashes, and the quotients of the aspect ratios
+        multiply, so the hash_margin and aspect_margin of the representative cover the stages of the cascade a member
+        would have passed.
+
+        This only holds for the thumbnail comparison at the size of the catalog. compare_images compares at the
+        resolution of the image, where the deviation from the representative can be larger than on the thumbnails.
+
+        Parameters
+        ----------
+        distance: float
+            mean pixel deviation below which a logo is merged into a cluster
+
+        Returns
+        -------
+        clusters: list
+            [representative, tolerances, members] per cluster, tolerances has the keys of DEFAULT_TOLERANCES and
+            members maps the merged logos to their deviation from the representative
+        """
+        clusters = []
+        representatives = []
+        for logo in sorted(self.logos, key=lambda name: (int(sub(r'\D', '', name) or 0), name)):
+            thumbnail = self.thumbnails[self.positions[logo]]
+            if len(representatives) > 0:
+                deviations = np.abs(np.stack(representatives) - thumbnail).mean(axis=(1, 2, 3))
+                closest = int(np.argmin(deviations))
+                if deviations[closest] < distance:
+                    cluster = clusters[closest]
+                    tolerances = cluster[1]
+                    representative = cluster[0]
+                    aspect_ratio = self.aspect_ratios[self.positions[logo]]
+                    representative_aspect_ratio = self.aspect_ratios[self.positions[representative]]
+                    tolerances['tolerance'] = max(tolerances['tolerance'],
+                                                  self.tolerances[logo] + float(deviations[closest]))
+                    tolerances['hash_margin'] = max(tolerances['hash_margin'], self.hash_margins[logo] +
+                                                    BKTree.distance(self.hashes[logo], self.hashes[representative]))
+                    tolerances['aspect_margin'] = max(tolerances['aspect_margin'], self.aspect_margins[logo] *
+                                                      max(aspect_ratio / representative_aspect_ratio,
+                                                          representative_aspect_ratio / aspect_ratio))
+                    cluster[2][logo] = float(deviations[closest])
+                    continue
+
+            clusters.append([logo, self.logo_tolerances(logo), {}])
+            representatives.append(thumbnail)
+
+        return clusters
+
+
+def reject_candidates(stage, candidates, keep):
+    """
+    Returns the candidates to keep and counts the rejected ones for the stage in cascade_counts
+
+    Parameters
+    ----------
+    stage: string
+        key of the stage in cascade_counts
+
+    candidates: array
+        positions of the candidate logos in the catalog
+
+    keep: array
+        boolean mask of the candidates that pass the stage
+    """
+    cascade_counts[stage] += int(np.count_nonzero(~keep))
+
+    return candidates[keep]
+
+
+def logo_number(logo):
+    """
+    Returns the number of a logo named logo_<number> by add_data_to_catalog, 0 for other names
+    """
+    number = search(r'^logo_(\d+)', logo)
+
+    return int(number.group(1)) if number is not None else 0
+
+
+# Shared by all files of the run, the logos are only decoded once
+logo_catalog = LogoCatalog()
+
+
+class VerdictCache:
+    """
+    Persistent cache of the comparisons of images with the logo catalog, in a SQLite database in the LogFolder. The
+    verdicts are keyed by the SHA-256 of the image content and the catalog version, so byte-identical media seen in
+    an earlier file or an earlier run is answered without decoding and comparing it again.
+
+    The main process is the only one that writes to the database. Worker processes of the pool open it read-only and
+    keep their verdicts in new_verdicts, which task_state hands to the main process to store.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.connection = None
+        # Verdicts found by a worker process of the pool, None when the verdicts are stored right away
+        self.new_verdicts = None
+
+    def open(self, log_folder):
+        """
+        Opens the database of the log folder, unless it's open already
+
+        Parameters
+        ----------
+        log_folder: string
+            path to the LogFolder
+        """
+        path = os.path.join(log_folder, 'verdict_cache.sqlite')
+        if self.path == path:
+            return
+
+        self.path = path
+        if self.new_verdicts is not None:
+            # Created by run_pool before the workers start
+            self.connection = sqlite3.connect(pathlib.Path(path).absolute().as_uri() + '?mode=ro', uri=True,
+                                              timeout=30)
+            return
+
+        # Autocommit without syncing, losing the latest verdicts on a crash only costs their comparisons
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS verdicts (image_hash TEXT, catalog_version TEXT, '
+                                'mode TEXT, logo TEXT, PRIMARY KEY (image_hash, catalog_version, mode))')
+
+    def get(self, image_hash, catalog_version, mode):
+        """
+        Returns whether a verdict is cached and the name of the matched logo, None if no logo matched
+        """
+        key = (image_hash, catalog_version, mode)
+        if self.new_verdicts is not None and key in self.new_verdicts:
+            return True, self.new_verdicts[key]
+
+        row = self.connection.execute('SELECT logo FROM verdicts WHERE image_hash = ? AND catalog_version = ? '
+                                      'AND mode = ?', (image_hash, catalog_version, mode)).fetchone()
+
+        return (True, row[0]) if row is not None else (False, None)
+
+    def put(self, image_hash, catalog_version, mode, logo):
+        """
+        Stores the verdict of an image, logo is None if no logo matched. A worker process keeps it in new_verdicts
+        """
+        if self.new_verdicts is not None:
+            self.new_verdicts[(image_hash, catalog_version, mode)] = logo
+            return
+
+        self.connection.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?)',
+                                (image_hash, catalog_version, mode, logo))
+
+
+verdict_cache = VerdictCache()
+
+
+def find_matching_logo(probe, config, catalog_check=False):
+    """
+    Returns the name of the logo of the catalog that is similar to the image, or None. Only the logos that pass the
+    cheaper stages of LogoCatalog.cascade, the aspect ratio, mean colour and perceptual hash, are compared pixel by
+    pixel. With VerdictCache enabled an image is only compared once per catalog version, later on it's answered from
+    the cache.
+
+    Parameters
+    ----------
+    probe: ImageProbe obj
+        probe of the image
+
+    config: dictionary
+        dict containing information from the config file
+
+    catalog_check: bool
+        checks a header image before adding it to the catalog. With CatalogComparison = full it's compared with
+        compare_images, resized to each logo. Otherwise the thumbnail of the image is compared with the thumbnails of
+        all candidates at once, so the cost doesn't depend on the resolution of the image. Body images are compared
+        the same way below ThumbnailThreshold, with ThumbnailThreshold = off each logo is resized to the image for
+        compare_images instead
+
+    Returns
+    -------
+    logo: string
+        name of the matched logo, None if no logo is similar
+    """
+    logo_catalog.load(config["FoundLogosFolder"], config["ComparisonSize"])
+    mode = 'catalog' if catalog_check else 'body'
+
+    use_cache = "true" in config.get("VerdictCache", "false").lower()
+    if use_cache:
+        verdict_cache.open(config["LogFolder"])
+        key = (probe.digest(), logo_catalog.version(config), mode)
+        cached, logo = verdict_cache.get(*key)
+        if cached:
+            return logo
+
+    global image_comparisons
+    matched_logo = None
+    try:
+        # Only the header is read here, the pixels are decoded once the cascade needs them
+        probe.image()
+    except Exception:
+        # Images that can't be opened never match
+        probe = None
+
+    if probe is not None:
+        cascade_counts['images'] += 1
+        logo_locations = logo_catalog.cascade(probe, config)
+
+        thumbnail_threshold = config.get("ThumbnailThreshold")
+        if catalog_check and config.get("CatalogComparison", "fixed").lower() == "full":
+            for logo in logo_locations:
+                if compare_images(probe, logo_catalog.logos[logo], logo_catalog.tolerances[logo]):
+                    matched_logo = logo
+                    break
+                cascade_counts['pixels'] += 1
+        elif not catalog_check and thumbnail_threshold is None:
+            # The verdicts of the thumbnails differ from the ones at the resolution of the image, so body images are
+            # only compared on thumbnails when a threshold for them is configured
+            for logo in logo_locations:
+                if compare_images(logo_catalog.logos[logo], probe, logo_catalog.tolerances[logo]):
+                    matched_logo = logo
+                    break
+                cascade_counts['pixels'] += 1
+        elif len(logo_locations) > 0:
+            # Body images are similar below ThumbnailThreshold, merged logos keep their margin above it
+            offset = 0 if catalog_check else thumbnail_threshold - DEVIATION_THRESHOLD
+            logo, deviation = logo_catalog.match(probe, logo_locations)
+            image_comparisons += len(logo_locations)
+            if deviation < logo_catalog.tolerances[logo] + offset:
+                matched_logo = logo
+            cascade_counts['pixels'] += len(logo_locations) - (matched_logo is not None)
+
+        if matched_logo is not None:
+            cascade_counts['matched'] += 1
+
+    if use_cache:
+        verdict_cache.put(*key, matched_logo)
+
+    return matched_logo
+
+
+def compare_images(image_path1, image_path2, threshold=DEVIATION_THRESHOLD):
     """
     Compare two images based on their pixel values and determine their similarity.
 
     Args:
-        image_path1 (str): File path of the first image.
-        image_path2 (str): File path of the second image.
+        image_path1 (str, file object, Image or ImageProbe): File path of the first image, its content, the decoded
+            image or its probe.
+        image_path2 (str, file object, Image or ImageProbe): File path of the second image, its content, the decoded
+            image or its probe.
+        threshold (float): Mean pixel deviation below which the images are similar, the tolerance of the logo.
 
     Returns:
         bool: True if the images are considered similar, False otherwise.
@@ -2162,9 +3910,10 @@ def compare_images(image_path1, image_path2):
 
     # Catch any unsupported image files
     try:
-        # Open the images
-        image1 = Image.open(image_path1)
-        image2 = Image.open(image_path2)
+        # Open the images, the logos of the catalog and probed images are already decoded
+        image1, image2 = [image.decoded() if isinstance(image, ImageProbe) else
+                          image if isinstance(image, Image.Image) else Image.open(image)
+                          for image in (image_path1, image_path2)]
 
         # Resize the images to ensure they have the same dimensions
         image1 = image1.resize(image2.size)
@@ -2173,15 +3922,15 @@ def compare_images(image_path1, image_path2):
         image1 = image1.convert("RGB")
         image2 = image2.convert("RGB")
 
-        # Convert images to NumPy arrays
-        image1_array = np.asarray(image1)
-        image2_array = np.asarray(image2)
+        # Convert images to signed NumPy arrays, so negative differences don't wrap around
+        image1_array = np.asarray(image1, dtype=np.int16)
+        image2_array = np.asarray(image2, dtype=np.int16)
 
         # Calculate deviation
         deviation = np.mean(np.abs(image1_array - image2_array))
 
         # Pictures are similar if their deviation is lower than the set threshold
-        similarity = deviation < 15
+        similarity = deviation < threshold
 
         # Increment counter
         image_comparisons += 1
@@ -2228,6 +3977,15 @@ def map_config(configfile):
                     #    cfg_dict["case-unsensitive"].append(new)
                     cfg_dict["ReplaceString"].append([old.strip(), new.strip()])
 
+    # Compile the replacement rules once for the whole run
+    cfg_dict["ReplaceMatcher"] = ReplaceMatcher(cfg_dict["ReplaceString"])
+    cfg_dict["CompressionPolicy"] = CompressionPolicy(cfg_dict.get("Compression", ""),
+                                                      cfg_dict.get("CompressionDefault", "deflate"))
+    comparison_size = int(cfg_dict.get("ComparisonSize", "96"))
+    cfg_dict["ComparisonSize"] = (comparison_size, comparison_size)
+    thumbnail_threshold = cfg_dict.get("ThumbnailThreshold", "14.5")
+    cfg_dict["ThumbnailThreshold"] = None if thumbnail_threshold.lower() in ("", "off") else float(thumbnail_threshold)
+
     return cfg_dict
 
 
@@ -2285,5 +4043,260 @@ def reset_log_info():
     log_information['Warning'] = ''
 
 
+def reset_task_state():
+    """
+    Resets the module globals a worker process collects the state of one file in
+
+    Returns:
+        None
+    """
+    global image_comparisons, catalog_images
+    reset_log_info()
+    header_images.clear()
+    scanned_word_files.clear()
+    pdfs.clear()
+    for file_type in file_run_times:
+        file_run_times[file_type] = 0.0
+    image_comparisons = 0
+    for stage in cascade_counts:
+        cascade_counts[stage] = 0
+    catalog_images = []
+    verdict_cache.new_verdicts = {}
+
+
+def task_state():
+    """
+    Returns the state a worker process collected while processing one file, merged by merge_task_state in the main
+    process
+
+    Returns:
+        state (dict): Log information, header images, scanned Word files, PDF files, run times, comparison counts,
+            the header images to add to the catalog and the verdicts to store in the verdict cache.
+    """
+    return {
+        'log_information': dict(log_information),
+        'header_images': dict(header_images),
+        'scanned_word_files': sorted(scanned_word_files),
+        'pdfs': list(pdfs),
+        'file_run_times': dict(file_run_times),
+        'image_comparisons': image_comparisons,
+        'cascade_counts': dict(cascade_counts),
+        'catalog_images': list(catalog_images),
+        'verdicts': list(verdict_cache.new_verdicts.items())
+    }
+
+
+def merge_task_state(state, config):
+    """
+    Merges the state of a file processed by a worker process into the module globals of the main process, stores its
+    verdicts in the verdict cache and adds its header images to the catalog
+
+    Args:
+        state (dict): State returned by task_state.
+        config (dict): Dictionary containing information from the config file.
+
+    Returns:
+        None
+    """
+    global image_comparisons
+    header_images.update(state['header_images'])
+    scanned_word_files.update(state['scanned_word_files'])
+    pdfs.extend(state['pdfs'])
+    for file_type, duration in state['file_run_times'].items():
+        file_run_times[file_type] = file_run_times[file_type] + duration
+    image_comparisons += state['image_comparisons']
+    for stage, count in state['cascade_counts'].items():
+        cascade_counts[stage] += count
+    if len(state['verdicts']) > 0:
+        verdict_cache.open(config["LogFolder"])
+        for key, logo in state['verdicts']:
+            verdict_cache.put(*key, logo)
+    for image_location, image_data in state['catalog_images']:
+        add_data_to_catalog(image_data, image_location, config)
+
+
+def init_worker(config):
+    """
+    Keeps the config in a worker process of the pool
+
+    Args:
+        config (dict): Dictionary containing information from the config file.
+
+    Returns:
+        None
+    """
+    global worker_config, verdict_cache
+    worker_config = config
+    # A forked worker must not use the connection of the main process, it opens the verdict cache read-only itself
+    verdict_cache = VerdictCache()
+
+
+def process_task(task):
+    """
+    Processes one file in a worker process of the pool
+
+    Args:
+        task (tuple): Phase ('header', 'body' or 'rewrite' for the Word files scanned in the header phase), file
+            name, input path, output path and, for the body phase, the paths of the header images of the file.
+
+    Returns:
+        result (dict): Status ('processed' or 'failed') and error of the file, its processing time in seconds and the
+            state collected while processing it.
+    """
+    phase, file, file_in, file_out, header_image_paths = task
+    reset_task_state()
+    start_time = time()
+    status, error = 'processed', ''
+
+    try:
+        # get_filetype sets the type of the file in the config, every task gets its own copy
+        config = get_filetype(file, dict(worker_config))
+        config["OldLogoPath_formatted"] = config["OldLogoPath"].format(filetype=config["filetype"])
+        config["LegacyBHLogoPath_formatted"] = config["LegacyBHLogoPath"].format(filetype=config["filetype"])
+
+        log_information['Inputfile'] = file_in
+        if phase == 'header':
+            process_file(file_in, file_out, config)
+        elif phase == 'rewrite':
+            process_file_word(file_in, file_out, config, body_images=True)
+        else:
+            if header_image_paths is not None:
+                header_images[file] = header_image_paths
+            place_logo_body(file_in, file_out, config)
+    except Exception as e:
+        status, error = 'failed', str(e)
+
+    return {'status': status, 'error': error, 'seconds': time() - start_time, 'state': task_state()}
+
+
+def run_pool(tasks, config, workers):
+    """
+    Yields the results of the tasks processed by a pool of worker processes, in the order of the tasks. Every call
+    starts a new pool, so its workers load the logo catalog as it is at that point.
+
+    Args:
+        tasks (list): Tasks for process_task.
+        config (dict): Dictionary containing information from the config file.
+        workers (int): Number of worker processes.
+
+    Returns:
+        Generator of the results of process_task.
+    """
+    if "true" in config.get("VerdictCache", "false").lower():
+        # The workers open the verdict cache read-only, so it has to exist before they start
+        verdict_cache.open(config["LogFolder"])
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(config,)) as executor:
+        yield from executor.map(process_task, tasks)
+
+
+def run_header_tasks(tasks, config, workers, log, file_count):
+    """
+    Processes the files in a pool of worker processes. The Word and PDF files go first: their header images are
+    added to the catalog in the order of the files before the Excel and PowerPoint files are compared with it.
+
+    Args:
+        tasks (list): Header phase tasks for process_task, in the order of the files.
+        config (dict): Dictionary containing information from the config file.
+        workers (int): Number of worker processes.
+        log (file): Open log file.
+        file_count (int): Number of files in the input folder.
+
+    Returns:
+        failure_count (int): Number of files that failed to process.
+    """
+    failure_count = 0
+    file_counter = 1
+    catalog_file_types = ('.docx', '.doc', '.docm', '.pdf')
+    stages = [[task for task in tasks if task[1].lower().endswith(catalog_file_types)],
+              [task for task in tasks if not task[1].lower().endswith(catalog_file_types)]]
+
+    for stage in stages:
+        if len(stage) == 0:
+            continue
+        for (phase, file, file_in, file_out, header_image_paths), result in zip(stage, run_pool(stage, config, workers)):
+            merge_task_state(result['state'], config)
+            print(f"File {file_counter}/{file_count} -- Processed {file} in {result['seconds']:.3f} seconds")
+            if result['status'] == 'failed':
+                print(f"File failed to process! File name: {file}\nError: {result['error']}")
+                failure_count += 1
+                log.write(f"{file_in};-;-;File failed to process!;Error:{result['error']};-\n")
+            else:
+                result['state']['log_information']['Time'] = str(result['seconds'])
+                log.write(';'.join([str(value) for key, value in result['state']['log_information'].items()
+                                    if key]) + '\n')
+            file_counter += 1
+
+    return failure_count
+
+
+def run_body_tasks(tasks, config, workers, log, file_count):
+    """
+    Replaces the body images of the files in a pool of worker processes
+
+    Args:
+        tasks (list): Body phase tasks for process_task, in the order of the files.
+        config (dict): Dictionary containing information from the config file.
+        workers (int): Number of worker processes.
+        log (file): Open log file.
+        file_count (int): Number of files in the input folder.
+
+    Returns:
+        failure_count (int): Number of files whose body images failed to be replaced.
+    """
+    failure_count = 0
+    file_counter = 1
+
+    for (phase, file_body, file_in, file_out, header_image_paths), result in zip(tasks,
+                                                                                 run_pool(tasks, config, workers)):
+        merge_task_state(result['state'], config)
+        print(f'File {file_counter}/{file_count} -- Replaced body image for: {file_in}')
+        if result['status'] == 'failed':
+            print(f"Failed replacing the body images for file: {file_body} \nError: {result['error']}")
+            failure_count += 1
+            log.write(f"{file_in};-;-;Failed replacing the body images!;Error:{result['error']};-\n")
+        elif file_in.endswith('.docx'):
+            result['state']['log_information']['Time'] = str(result['seconds'])
+            log.write(';'.join([str(value) for key, value in result['state']['log_information'].items()
+                                if key]) + '\n')
+
+        file_counter += 1
+        finish_body_file(file_in, file_out, result['seconds'], log)
+
+    return failure_count
+
+
+def finish_body_file(file_in, file_out, duration, log):
+    """
+    Converts a file back to PDF if it was a PDF originally and adds its processing time to the run times
+
+    Args:
+        file_in (str): Path to the file in the HeaderImageReplacedFoler.
+        file_out (str): Path to the file in the OutputFolder.
+        duration (float): Seconds spent replacing its body images.
+        log (file): Open log file.
+
+    Returns:
+        None
+    """
+    start_time = time()
+
+    # If the current input file originally was 'pdf', convert it back to pdf
+    if os.path.basename(file_in).replace('.docx', '.pdf') in pdfs:
+        file_out_pdf = file_out.replace('.docx', '.pdf')  # Update the output path with 'pdf' extension
+        try:
+            ConvertDocx2Pdf(file_out, file_out_pdf)  # Convert docx to pdf
+            os.remove(file_out)  # Remove the docx copy from the output folder
+        except Exception as e:
+            log.write(f'{file_out};-;-;Failed converting to PDF;Error{e};-\n')
+            return
+
+        # Increment PDF processing timer
+        file_run_times['pdf'] = file_run_times['pdf'] + duration + (time() - start_time)
+    else:
+        # Increment word processing timer
+        file_run_times['word'] = file_run_times['word'] + duration
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,110 @@
+"""
+Logo catalog maintenance for bh_rebrand.py
+
+Clusters the near-duplicate logos of the FoundLogosFolder, which header images scaled or antialiased differently
+leave behind. The oldest logo of each cluster is kept as its representative and the other members are deleted. The
+representative gets tolerances that cover every image similar to one of the deleted members: a larger pixel
+deviation, perceptual hash distance and aspect ratio difference, stored in catalog_tolerances.json in the same
+folder, so body images that matched a member pass every stage of the comparison with the representative. The
+comparisons of the body images then grow with the number of distinct logos instead of the number of scanned headers.
+
+The tolerances are measured on the thumbnails at the ComparisonSize of the config, so they only cover images compared
+on thumbnails of that size. The logos are only merged if the config compares body images on thumbnails
+(ThumbnailThreshold) and header images as well (CatalogComparison = fixed).
+
+Usage: python dedupe_logo_catalog.py [--config default_bh_rebrand.cfg] [--distance 5] [--dry-run]
+"""
+import argparse
+import json
+import os
+
+import bh_rebrand
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_tolerances(logo_folder, clusters):
+    """
+    Stores the tolerances of the representatives that differ from DEFAULT_TOLERANCES in the catalog folder
+
+    Parameters
+    ----------
+    logo_folder: string
+        path to the FoundLogosFolder
+
+    clusters: list
+        clusters returned by LogoCatalog.clusters
+    """
+    tolerances = {representative: logo_tolerances for representative, logo_tolerances, members in clusters
+                  if logo_tolerances != bh_rebrand.DEFAULT_TOLERANCES}
+    tolerances_path = os.path.join(logo_folder, bh_rebrand.CATALOG_TOLERANCES_FILE)
+
+    if len(tolerances) > 0:
+        with open(tolerances_path, 'w', encoding='utf-8') as tolerances_file:
+            json.dump(tolerances, tolerances_file, indent=2, sort_keys=True)
+    elif os.path.exists(tolerances_path):
+        os.remove(tolerances_path)
+
+
+def thumbnail_comparison(config):
+    """
+    Returns whether body images and header images are compared with the catalog on thumbnails, the comparison the
+    tolerances of the representatives cover
+
+    Parameters
+    ----------
+    config: dictionary
+        dict containing information from the config file
+    """
+    return config['ThumbnailThreshold'] is not None and config.get('CatalogComparison', 'fixed').lower() != 'full'
+
+
+def main():
+    """
+    Clusters the catalog, reports the reduction and removes the merged logos
+    """
+    parser = argparse.ArgumentParser(description='Merge the near-duplicate logos of the logo catalog')
+    parser.add_argument('--config', default=os.path.join(SCRIPT_FOLDER, 'default_bh_rebrand.cfg'),
+                        help='configuration file with the FoundLogosFolder and the ComparisonSize')
+    parser.add_argument('--distance', type=float, default=5.0,
+                        help='mean pixel deviation of the thumbnails below which logos are merged')
+    parser.add_argument('--dry-run', action='store_true', help='only report the clusters, keep the catalog unchanged')
+    arguments = parser.parse_args()
+
+    config = bh_rebrand.map_config(arguments.config)
+    logo_folder = config['FoundLogosFolder']
+
+    catalog = bh_rebrand.LogoCatalog()
+    catalog.load(logo_folder, config['ComparisonSize'])
+    clusters = catalog.clusters(arguments.distance)
+
+    for representative, tolerances, members in clusters:
+        if len(members) > 0:
+            merged = ', '.join(f'{logo} ({deviation:.1f})' for logo, deviation in members.items())
+            print(f'{representative}: tolerance {tolerances["tolerance"]:.1f}, hash margin '
+                  f'{tolerances["hash_margin"]}, aspect margin {tolerances["aspect_margin"]:.2f}, merged {merged}')
+
+    logos_before = len(catalog.logos)
+    logos_after = len(clusters)
+    reduction = 100 * (logos_before - logos_after) / logos_before if logos_before else 0.0
+    print(f'{logos_before} logos in {logo_folder}, {logos_after} after merging the near-duplicates '
+          f'({reduction:.1f}% fewer)')
+
+    if arguments.dry_run:
+        print('Dry run, the catalog is unchanged')
+        return
+
+    # Deleted logos can't be restored, so they're only merged if their matches are covered
+    if not thumbnail_comparison(config):
+        parser.error('the tolerances only cover the comparison on thumbnails, set ThumbnailThreshold and '
+                     'CatalogComparison = fixed in the config to merge the logos')
+
+    # Tolerances first, so an interrupted run never leaves the representatives without them
+    write_tolerances(logo_folder, clusters)
+    for representative, tolerances, members in clusters:
+        for logo in members:
+            os.remove(os.path.join(logo_folder, logo))
+
+
+if __name__ == '__main__':
+    main()